@@ -0,0 +1,433 @@
+"""
+Offline benchmark: runs monitor_loop end to end against local stand-ins
+(a fake stolo search server, an in-memory spreadsheet and a recording Bot)
+and reports cycle latency, request counts and peak memory per catalog size.
+
+    python bench_cycle.py --sizes 100,1000,10000 --cycles 3 --latency-ms 20 --error-rate 0.02
+    python bench_cycle.py --stall-rate 0.02 --stall-ms 5000   # tail latency (exercises hedging)
+    python bench_cycle.py --json before.json   # keep results to compare versions
+
+Nothing here talks to BMW, Google or Telegram.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import tempfile
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, parse_qs
+
+# =========================
+# Environment (before bmw_bot is imported: it reads its configuration at import time)
+# =========================
+START_DIR = os.getcwd()
+WORKDIR = tempfile.mkdtemp(prefix="bmw-bench-")
+os.environ.update({
+    "BOT_TOKEN": "123456:BENCHMARKbenchmark",
+    "CHAT_IDS": "1001,-1002",
+    "METRICS_PORT": "0",
+    "PROFILES_FILE": os.path.join(WORKDIR, "no-profiles.json"),
+})
+os.environ.setdefault("RETRY_BASE_DELAY", "0.1")
+os.environ.setdefault("LOG_QUEUE_SIZE", "100000")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(WORKDIR)  # logs/ and state DBs go to the scratch directory
+
+import bmw_bot  # noqa: E402
+
+# console output off, app.log/errors.log still written (under WORKDIR)
+bmw_bot._log_listener.handlers = tuple(
+    h for h in bmw_bot._log_listener.handlers if type(h) is not logging.StreamHandler
+)
+
+MAX_MILEAGE = 200000
+
+# =========================
+# Fake stolo search server
+# =========================
+class Catalog:
+    """Synthetic search results, newest first; mutated between cycles to simulate churn."""
+
+    def __init__(self, size: int, base_url: str, seed: int = 1):
+        self.rng = random.Random(seed)
+        self.base_url = base_url
+        self.next_id = 0
+        self.version = 0
+        self.vehicles: List[dict] = [self._vehicle() for _ in range(size)]
+        self._lock = threading.Lock()
+        self._filtered: Dict[tuple, List[dict]] = {}
+
+    def _vehicle(self) -> dict:
+        i = self.next_id
+        self.next_id += 1
+        return {
+            "vssId": f"BENCH{i:07d}",
+            "price": {"grossSalesPrice": self.rng.randrange(15000, 90000, 10)},
+            "vehicleLifeCycle": {"mileage": {"km": self.rng.randrange(0, MAX_MILEAGE)}},
+            "vehicleSpecification": {"modelAndOption": {
+                "model": {"marketingName": {"de_DE": self.rng.choice(["X3 xDrive20d", "X3 sDrive18d", "X3 M40i"])}},
+                "transmission": {"de_DE": self.rng.choice(["Automatik", "Schaltgetriebe"])},
+                "baseFuelType": {"de_DE": self.rng.choice(["Diesel", "Benzin"])},
+            }},
+            "images": [{"url": f"{self.base_url}/img/{i}-{k}.jpg"} for k in range(2)],
+        }
+
+    def churn(self, fraction: float):
+        """Reprices, removes and adds about `fraction` of the catalog (a third each)."""
+        n = max(1, int(len(self.vehicles) * fraction / 3))
+        with self._lock:
+            for v in self.rng.sample(self.vehicles, min(n, len(self.vehicles))):
+                v["price"] = {"grossSalesPrice": v["price"]["grossSalesPrice"] - 500}
+            for _ in range(min(n, len(self.vehicles))):
+                self.vehicles.pop(self.rng.randrange(len(self.vehicles)))
+            self.vehicles[:0] = [self._vehicle() for _ in range(n)]
+            self.version += 1
+            self._filtered.clear()
+
+    def search(self, body: dict) -> List[dict]:
+        ctx = (body.get("searchContext") or [{}])[0]
+        ranges = (ctx.get("usedCarData") or {}).get("mileageRanges") or [{}]
+        lo, hi = ranges[0].get("minValue", 0), ranges[0].get("maxValue", MAX_MILEAGE)
+        with self._lock:
+            hits = self._filtered.get((lo, hi))
+            if hits is None:
+                hits = self._filtered[(lo, hi)] = [
+                    v for v in self.vehicles if lo <= v["vehicleLifeCycle"]["mileage"]["km"] <= hi
+                ]
+            return hits
+
+class FakeStoloServer:
+    """Local HTTP server speaking just enough of the search API (POST search, HEAD images)."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, retry_after: int = 0, seed: int = 1,
+                 stall_rate: float = 0.0, stall: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate  # share of search requests that hang for `stall` seconds (tail latency)
+        self.stall = stall
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.catalog: Optional[Catalog] = None
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def count(self, key: str):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def reset_counts(self) -> Dict[str, int]:
+        with self._lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="fake-stolo", daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real API behind the pooled session
+
+            def _reply(self, code: int, body: bytes = b"", headers: Optional[Dict[str, str]] = None):
+                self.send_response(code)
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if body and self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def do_HEAD(self):
+                server.count("image_head")
+                self._reply(200, headers={"Content-Type": "image/jpeg"})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                server.count("search_post")
+                if server.latency:
+                    time.sleep(server.latency)
+                with server._lock:
+                    fail = server.rng.random() < server.error_rate
+                    throttle = fail and server.rng.random() < 0.5
+                    stall = server.rng.random() < server.stall_rate
+                if stall:
+                    server.count("injected_stall")
+                    time.sleep(server.stall)
+                if fail:
+                    server.count("injected_429" if throttle else "injected_502")
+                    if throttle:
+                        self._reply(429, b"slow down", {"Retry-After": str(server.retry_after)})
+                    else:
+                        self._reply(502, b"bad gateway")
+                    return
+                q = parse_qs(urlparse(self.path).query)
+                start = int(q.get("startIndex", ["0"])[0])
+                size = int(q.get("maxResults", ["100"])[0])
+                hits = server.catalog.search(body)
+                payload = {"hits": [{"vehicle": v} for v in hits[start:start + size]], "totalResults": len(hits)}
+                self._reply(200, json.dumps(payload).encode(), {"Content-Type": "application/json"})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+# =========================
+# In-memory gspread stand-ins
+# =========================
+def _a1_row(a1: str) -> int:
+    return int("".join(ch for ch in a1.split(":")[0] if ch.isdigit()))
+
+class FakeWorksheet:
+    """The subset of gspread.Worksheet the bot uses, kept in a list of rows."""
+
+    def __init__(self, spreadsheet: "FakeSpreadsheet", sheet_id: int, title: str):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.rows: List[list] = []
+
+    def _count(self, name: str):
+        self.spreadsheet.calls[name] = self.spreadsheet.calls.get(name, 0) + 1
+
+    def get_all_values(self):
+        self._count("get_all_values")
+        return [[str(c) for c in r] for r in self.rows]
+
+    def col_values(self, col: int):
+        self._count("col_values")
+        values = [str(r[col - 1]) if col - 1 < len(r) else "" for r in self.rows]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def _set_row(self, r: int, values: list):
+        while len(self.rows) < r:
+            self.rows.append([])
+        self.rows[r - 1] = list(values)
+
+    def update(self, range_name=None, values=None, value_input_option=None, **kwargs):
+        self._count("update")
+        self._set_row(_a1_row(range_name), values[0])
+
+    def batch_update(self, data, value_input_option=None, **kwargs):
+        self._count("values_batch_update")
+        for d in data:
+            self._set_row(_a1_row(d["range"]), d["values"][0])
+
+    def append_row(self, values, value_input_option=None, **kwargs):
+        self._count("append_row")
+        self.rows.append(list(values))
+
+    def append_rows(self, values, value_input_option=None, **kwargs):
+        self._count("append_rows")
+        self.rows.extend(list(r) for r in values)
+
+    def delete_rows(self, start_index, end_index=None):
+        self._count("delete_rows")
+        del self.rows[start_index - 1:end_index or start_index]
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.calls: Dict[str, int] = {}
+        self._sheets: Dict[str, FakeWorksheet] = {}
+        self.sheet1 = self.add_worksheet("Sheet1", 1000, len(bmw_bot.SHEET_COLUMNS))
+        self.sheet1.rows.append(list(bmw_bot.SHEET_COLUMNS))
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        from gspread.exceptions import WorksheetNotFound
+        try:
+            return self._sheets[title]
+        except KeyError:
+            raise WorksheetNotFound(title)
+
+    def add_worksheet(self, title: str, rows: int, cols: int) -> FakeWorksheet:
+        ws = self._sheets[title] = FakeWorksheet(self, len(self._sheets), title)
+        return ws
+
+    def batch_update(self, body: dict):
+        self.calls["spreadsheet_batch_update"] = self.calls.get("spreadsheet_batch_update", 0) + 1
+        by_id = {ws.id: ws for ws in self._sheets.values()}
+        for req in body["requests"]:
+            rng = req["deleteDimension"]["range"]
+            del by_id[rng["sheetId"]].rows[rng["startIndex"]:rng["endIndex"]]
+
+# =========================
+# Recording Bot
+# =========================
+class _Sent:
+    def __init__(self, file_id: Optional[str] = None):
+        self.photo = [type("PhotoSize", (), {"file_id": file_id})()] if file_id else None
+
+class FakeBot:
+    def __init__(self):
+        self.messages = 0
+        self.photos = 0
+        self.albums = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages += 1
+        return _Sent()
+
+    async def send_photo(self, chat_id, photo=None, caption=None, **kwargs):
+        self.photos += 1
+        return _Sent(photo if not str(photo).startswith("http") else f"file-{hash(photo) & 0xffffff:x}")
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self.albums += 1
+        return [_Sent(m.media if not str(m.media).startswith("http") else f"file-{hash(m.media) & 0xffffff:x}")
+                for m in media]
+
+# =========================
+# Scenario
+# =========================
+def drain_outbox(book, store) -> int:
+    calls = 0
+    while True:
+        n = bmw_bot.sync_sheet_once(book, store)
+        calls += 1
+        if n < bmw_bot.SHEET_SYNC_BATCH:
+            return calls
+
+async def run_scenario(server: FakeStoloServer, size: int, cycles: int, churn: float,
+                       partition: str, trace_memory: bool) -> List[dict]:
+    server.catalog = Catalog(size, server.url)
+    server.reset_counts()
+    spreadsheet = FakeSpreadsheet()
+    book = bmw_bot.SheetBook(spreadsheet)
+    fake_bot = FakeBot()
+
+    bmw_bot.bot = fake_bot
+    bmw_bot.dispatcher = bmw_bot.TelegramDispatcher(1e6)
+    bmw_bot.TG_CHAT_RATE = bmw_bot.TG_GROUP_RATE_PER_MIN = 1e6
+    bmw_bot.gs_open_book = lambda: book
+    bmw_bot.BMW_SEARCH_URL = f"{server.url}/vehiclesearch/search/de-de/gebrauchtwagen"
+    bmw_bot.SEARCH_PARTITION = partition
+    bmw_bot.POLL_INTERVAL = bmw_bot.POLL_MAX_INTERVAL = 0
+    bmw_bot.HEAD_POLL_INTERVAL = 0
+    bmw_bot._image_cache = bmw_bot.TTLCache(bmw_bot.IMAGE_CACHE_SIZE, bmw_bot.IMAGE_CACHE_TTL)
+
+    data = bmw_bot.build_beta_filters()
+    data["searchContext"][0]["usedCarData"] = {"mileageRanges": [{"minValue": 0, "maxValue": MAX_MILEAGE}]}
+    profiles = [bmw_bot.SearchProfile("bench", data, tuple(bmw_bot.CHAT_IDS), "")]
+    store = bmw_bot.LotStore(os.path.join(WORKDIR, f"state-{size}-{time.time_ns()}.db"))
+
+    results: List[dict] = []
+    done = asyncio.Event()
+    full_sweep = bmw_bot.full_sweep
+
+    async def timed_sweep(profiles_, store_, **kwargs):
+        if trace_memory:
+            tracemalloc.reset_peak()
+        sheet_calls_before = sum(spreadsheet.calls.values())
+        hedges_before = bmw_bot.metrics.counter("api_hedge")
+        t0 = time.perf_counter()
+        changes = await full_sweep(profiles_, store_, **kwargs)
+        t1 = time.perf_counter()
+        await bmw_bot.dispatcher.join()
+        t2 = time.perf_counter()
+        sync_passes = await bmw_bot.run_blocking(bmw_bot._sheets_pool, drain_outbox, book, store_)
+        t3 = time.perf_counter()
+        counts = server.reset_counts()
+        results.append({
+            "size": size,
+            "cycle": len(results) + 1,
+            "changes": changes,
+            "sweep_s": round(t1 - t0, 3),
+            "tg_drain_s": round(t2 - t1, 3),
+            "sheet_sync_s": round(t3 - t2, 3),
+            "search_requests": counts.get("search_post", 0),
+            "image_requests": counts.get("image_head", 0),
+            "injected_errors": counts.get("injected_429", 0) + counts.get("injected_502", 0),
+            "stalls": counts.get("injected_stall", 0),
+            "hedges": int(bmw_bot.metrics.counter("api_hedge") - hedges_before),
+            "sheet_requests": sum(spreadsheet.calls.values()) - sheet_calls_before,
+            "sheet_sync_passes": sync_passes,
+            "tg_sends": fake_bot.messages + fake_bot.photos + fake_bot.albums,
+            "peak_mb": round(tracemalloc.get_traced_memory()[1] / 2**20, 1) if trace_memory else None,
+        })
+        fake_bot.messages = fake_bot.photos = fake_bot.albums = 0
+        if len(results) >= cycles:
+            done.set()
+            await asyncio.Event().wait()  # park the loop here until it is cancelled
+        server.catalog.churn(churn)
+        return changes
+
+    bmw_bot.full_sweep = timed_sweep
+    task = asyncio.create_task(bmw_bot.monitor_loop(profiles, store))
+    try:
+        await asyncio.wait([task, asyncio.create_task(done.wait())], return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            task.result()  # surface a crash of the loop itself
+    finally:
+        task.cancel()
+        for worker in bmw_bot.dispatcher._workers.values():
+            worker.cancel()
+        await asyncio.gather(task, *bmw_bot.dispatcher._workers.values(), return_exceptions=True)
+        bmw_bot.full_sweep = full_sweep
+    return results
+
+def print_table(rows: List[dict]):
+    cols = ["size", "cycle", "changes", "sweep_s", "tg_drain_s", "sheet_sync_s", "search_requests",
+            "image_requests", "injected_errors", "stalls", "hedges", "sheet_requests", "tg_sends", "peak_mb"]
+    widths = [max(len(c), *(len(str(r[c])) for r in rows)) for c in cols]
+    print("  ".join(c.rjust(w) for c, w in zip(cols, widths)))
+    for r in rows:
+        print("  ".join(str(r[c]).rjust(w) for c, w in zip(cols, widths)))
+
+async def main(args):
+    server = FakeStoloServer(args.latency_ms / 1000, args.error_rate, args.retry_after, args.seed,
+                             args.stall_rate, args.stall_ms / 1000)
+    server.start()
+    if args.trace_memory:
+        tracemalloc.start()
+    rows: List[dict] = []
+    try:
+        for size in args.sizes:
+            partition = args.partition
+            if partition == "auto":
+                # one search returns at most 50 pages of 100; beyond that only shards see everything
+                partition = "mileage" if size > 5000 else ""
+            rows += await run_scenario(server, size, args.cycles, args.churn, partition, args.trace_memory)
+    finally:
+        server.stop()
+    print_table(rows)
+    if args.json:
+        args.json = os.path.join(START_DIR, args.json)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "json"}, "results": rows}, f, indent=2)
+        print(f"\nSaved to {args.json}")
+    print(f"Logs and state: {WORKDIR}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the monitoring cycle")
+    parser.add_argument("--sizes", type=lambda s: [int(x) for x in s.split(",")], default=[100, 1000, 10000],
+                        help="catalog sizes, comma separated")
+    parser.add_argument("--cycles", type=int, default=3, help="full sweeps per size (the first one is cold)")
+    parser.add_argument("--churn", type=float, default=0.02, help="share of the catalog changed between cycles")
+    parser.add_argument("--latency-ms", type=float, default=20, help="fake API latency per search request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of search requests answered 429/502")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="share of search requests that hang (tail latency)")
+    parser.add_argument("--stall-ms", type=float, default=5000, help="how long a hanging search request takes")
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--partition", default="auto", choices=["auto", "", "date", "mileage"],
+                        help="SEARCH_PARTITION for the run (auto: mileage above 5000 vehicles)")
+    parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+                        help="skip tracemalloc (it slows Python code down noticeably)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    asyncio.run(main(parser.parse_args()))
@@ -4,17 +4,35 @@ import json
 import time
 import asyncio
 import logging
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import copy
+import functools
+import hashlib
+import random
+import zlib
+import argparse
+import bisect
+import math
 import requests
-from datetime import datetime
-from typing import Optional, Dict, List, Tuple, Set
-from logging.handlers import TimedRotatingFileHandler
+from datetime import datetime, date, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, List, Tuple, Set, Iterable, Callable, Awaitable, NamedTuple, AsyncIterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from requests.adapters import HTTPAdapter
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import Command
-from aiogram.types import FSInputFile
-from aiogram.exceptions import TelegramNetworkError
+from aiogram.filters import Command, CommandObject
+from aiogram.types import FSInputFile, InputMediaPhoto
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramBadRequest
 from dotenv import load_dotenv
 
 # =========================
@@ -26,25 +44,195 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHAT_IDS = [int(x) for x in os.getenv("CHAT_IDS", "").split(",") if x.strip()]
 ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
 
-POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "60"))
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "60"))  # full sweep
+HEAD_POLL_INTERVAL = int(os.getenv("HEAD_POLL_INTERVAL", "5"))  # top pages only; 0 = disabled
+HEAD_PAGES = max(1, int(os.getenv("HEAD_PAGES", "1")))
+# Adaptive scheduling: intervals stretch up to these while nothing changes
+POLL_MAX_INTERVAL = int(os.getenv("POLL_MAX_INTERVAL", str(POLL_INTERVAL * 5)))
+HEAD_POLL_MAX_INTERVAL = int(os.getenv("HEAD_POLL_MAX_INTERVAL", "60"))
+POLL_JITTER = 0.2  # +-20% on every interval
+RATE_HALF_LIFE_DAYS = 7  # weight of old observations in the per-hour change rate
 MAX_RETRIES = 3
-TELEGRAM_DELAY = 1.2
+# Per-page retries on 429/5xx/network errors (exponential backoff with jitter, Retry-After honored)
+PAGE_MAX_RETRIES = int(os.getenv("PAGE_MAX_RETRIES", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "120"))
+API_TIMEOUT = 30  # seconds per search request
+# Hedged search requests: a page unanswered after the HEDGE_QUANTILE latency of recent pages gets
+# a duplicate request, the first answer wins; at most HEDGE_MAX_RATIO of recent requests are hedges (0 = off)
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.5"))
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+HEDGE_MIN_SAMPLES = 20  # latencies needed before the deadline is trusted
+HEDGE_WINDOW = 200  # requests and hedges HEDGE_MAX_RATIO is enforced over
+# Circuit breaker: after BREAKER_FAILURES failed requests in a row the API is left alone for
+# BREAKER_RESET seconds, then probed with one request (the pause doubles while probes fail)
+BREAKER_FAILURES = max(1, int(os.getenv("BREAKER_FAILURES", "5")))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "30"))
+BREAKER_MAX_RESET = 600
+
+# Telegram limits: ~30 msg/s per bot, ~1 msg/s per private chat, 20 msg/min per group
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_GROUP_RATE_PER_MIN = float(os.getenv("TG_GROUP_RATE_PER_MIN", "20"))
+# Digest mode: past DIGEST_THRESHOLD new (or removed) lots per chat in one cycle, the rest are
+# coalesced into digest messages and photo albums instead of one message per lot; 0 = off
+DIGEST_THRESHOLD = int(os.getenv("DIGEST_THRESHOLD", "20"))
+TG_ALBUM_SIZE = 10  # send_media_group takes 2..10 items
+TG_MESSAGE_LIMIT = 4096
+TG_CAPTION_LIMIT = 1024
+FETCH_CONCURRENCY = max(1, int(os.getenv("FETCH_CONCURRENCY", "4")))
+
+IMAGE_PROBE_WORKERS = max(1, int(os.getenv("IMAGE_PROBE_WORKERS", "8")))
+IMAGE_CACHE_TTL = int(os.getenv("IMAGE_CACHE_TTL", "86400"))
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "5000"))
+IMAGE_NEGATIVE_TTL = 600  # failed probes are retried sooner
+# Result pages remembered per (search, startIndex): an identical body is not decoded or parsed again
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "2000"))
+PAGE_CACHE_TTL = 6 * 3600
+MAX_IMAGE_CANDIDATES = 5  # image URLs kept per lot
+
+# Search partitioning: "" (off), "date" or "mileage"
+SEARCH_PARTITION = os.getenv("SEARCH_PARTITION", "").strip().lower()
+SHARD_MAX_RESULTS = int(os.getenv("SHARD_MAX_RESULTS", "1000"))
+SHARD_CONCURRENCY = max(1, int(os.getenv("SHARD_CONCURRENCY", "3")))
 
 GS_CRED = os.getenv("GS_CRED", "bmwparser111-4e64ca22a559.json")
 GSHEET_NAME = os.getenv("GSHEET_NAME", "bmw_parser_data")
+SHEET_SYNC_INTERVAL = int(os.getenv("SHEET_SYNC_INTERVAL", "30"))
+SHEET_SYNC_BATCH = int(os.getenv("SHEET_SYNC_BATCH", "500"))
+# The sheet is re-read (and deduped/repaired) this often; in between, syncs work on a checkpointed copy
+SHEET_VERIFY_INTERVAL = int(os.getenv("SHEET_VERIFY_INTERVAL", "900"))
+# Alerts not delivered before a restart are resent if they are younger than this (seconds)
+NOTIFY_RESUME_MAX_AGE = int(os.getenv("NOTIFY_RESUME_MAX_AGE", "21600"))
+
+STATE_DB = os.getenv("STATE_DB", "state.db")
+# Worker mode: processes with distinct WORKER_IDs sharing STATE_DB split the profiles via leases
+WORKER_ID = os.getenv("WORKER_ID", "").strip()
+LEASE_TTL = float(os.getenv("LEASE_TTL", "60"))  # a dead worker's profiles move on after this
+# /stats: lots listed/gone and days on market cover the last STATS_WINDOW_DAYS days;
+# mileage filters work in these bands (km)
+STATS_WINDOW_DAYS = max(1, int(os.getenv("STATS_WINDOW_DAYS", "7")))
+STATS_MILEAGE_BANDS = sorted(
+    int(x) for x in os.getenv("STATS_MILEAGE_BANDS", "10000,20000,40000,60000,100000,150000").split(",") if x.strip()
+)
+
+# Per-cycle archive of the search results (delta-encoded, compressed); empty ARCHIVE_DB = off
+ARCHIVE_DB = os.getenv("ARCHIVE_DB", "archive.db")
+ARCHIVE_KEYFRAME_EVERY = max(1, int(os.getenv("ARCHIVE_KEYFRAME_EVERY", "48")))
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", "180"))
+
+# Saved searches (see profiles_template.json); without the file the built-in search is used
+PROFILES_FILE = os.getenv("PROFILES_FILE", "profiles.json")
+PROFILE_CONCURRENCY = max(2, int(os.getenv("PROFILE_CONCURRENCY", "4")))
+
+LOOP_LAG_WARN_MS = int(os.getenv("LOOP_LAG_WARN_MS", "200"))
+
+# Prometheus-style metrics on http://METRICS_HOST:METRICS_PORT/metrics (port 0 = off)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "1000"))  # recent samples kept per stage
+
+# Sheet columns A..H; CHANGE_ALERT_FIELDS picks which field changes are sent to Telegram
+SHEET_COLUMNS = ["vssId", "model", "price", "mileage", "gearbox", "fuel", "url", "date_added"]
+LOT_FIELDS = ["model", "price", "mileage", "gearbox", "fuel"]
+CHANGE_ALERT_FIELDS = {x.strip() for x in os.getenv("CHANGE_ALERT_FIELDS", "price").split(",") if x.strip()}
 
 LOGDIR = "logs"
 APP_LOG = os.path.join(LOGDIR, "app.log")
 ERR_LOG = os.path.join(LOGDIR, "errors.log")
 os.makedirs(LOGDIR, exist_ok=True)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()  # "text" or "json" (one object per line)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
 
 # =========================
 # Logging
 # =========================
+# Callers only enqueue records; a listener thread does the console and file I/O
+# (including midnight rotation), so a slow disk never stalls the event loop.
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%d %H:%M:%S"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class ConsoleFormatter(logging.Formatter):
+    """Bare message, like the print() the console used to get."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return record.getMessage()
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Enqueues without blocking; when the queue is full the record is dropped and counted.
+    Errors get a short blocking put instead, so they are only lost if the writer is stuck.
+    """
+
+    def __init__(self, q: "queue.Queue"):
+        super().__init__(q)
+        self.enqueued = 0
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # render message and traceback here, keep them apart for the formatters downstream
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if record.levelno >= logging.ERROR:
+                self.queue.put(record, timeout=1.0)
+            else:
+                self.queue.put_nowait(record)
+            self.enqueued += 1
+        except queue.Full:
+            self.dropped += 1
+
+class DropReportingListener(QueueListener):
+    """Writes a note into the logs whenever records were dropped since the last one."""
+
+    def __init__(self, q: "queue.Queue", source: DroppingQueueHandler, *handlers):
+        super().__init__(q, *handlers, respect_handler_level=True)
+        self.source = source
+        self.reported = 0
+
+    def handle(self, record: logging.LogRecord):
+        dropped = self.source.dropped
+        if dropped > self.reported:
+            note = logging.makeLogRecord({
+                "name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                "msg": f"[LOG] {dropped - self.reported} record(s) dropped, log queue full ({LOG_QUEUE_SIZE})",
+            })
+            self.reported = dropped
+            super().handle(note)
+        super().handle(record)
+
+    def stop(self):
+        if self._thread is not None:  # idempotent: /restart stops it before atexit would
+            super().stop()
+
 def setup_logging():
     logger = logging.getLogger("bmw_monitor")
     logger.setLevel(logging.INFO)
-    fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S")
+    if LOG_FORMAT == "json":
+        fmt: logging.Formatter = JsonLineFormatter()
+    else:
+        fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s", "%Y-%m-%d %H:%M:%S")
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(ConsoleFormatter())
 
     info_handler = TimedRotatingFileHandler(APP_LOG, when="midnight", backupCount=14, encoding="utf-8")
     info_handler.setLevel(logging.INFO)
@@ -54,24 +242,229 @@ def setup_logging():
     err_handler.setLevel(logging.ERROR)
     err_handler.setFormatter(fmt)
 
+    q: "queue.Queue" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(q)
+    listener = DropReportingListener(q, queue_handler, console_handler, info_handler, err_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
     logger.handlers.clear()
-    logger.addHandler(info_handler)
-    logger.addHandler(err_handler)
-    return logger
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    return logger, queue_handler, listener
 
-_logger = setup_logging()
+_logger, _log_queue_handler, _log_listener = setup_logging()
 
 def log_info(msg: str):
-    print(msg, flush=True)
     _logger.info(msg)
 
 def log_error(msg: str, exc: Optional[Exception] = None):
-    print(msg, flush=True)
     if exc is not None:
-        _logger.exception(f"{msg} | EXC: {exc}")
+        _logger.error(f"{msg} | EXC: {exc}", exc_info=exc)
     else:
         _logger.error(msg)
 
+# =========================
+# Executors (the event loop only awaits; blocking I/O runs on these bounded pools)
+# =========================
+_sheets_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gsheets")  # gspread client is not thread-safe
+_api_pool = ThreadPoolExecutor(max_workers=PROFILE_CONCURRENCY, thread_name_prefix="bmw-api")  # one per profile sweep
+_fetch_pool = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="bmw-fetch")  # search pages
+_shard_pool = ThreadPoolExecutor(max_workers=SHARD_CONCURRENCY, thread_name_prefix="bmw-shard")
+# the HTTP calls themselves (primary and hedge); a hedge's loser keeps its thread until it ends
+_request_pool = ThreadPoolExecutor(max_workers=3 * (FETCH_CONCURRENCY + SHARD_CONCURRENCY), thread_name_prefix="bmw-http")
+_probe_pool = ThreadPoolExecutor(max_workers=IMAGE_PROBE_WORKERS, thread_name_prefix="img-probe")
+_archive_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")  # snapshot archive writes
+
+async def run_blocking(pool: ThreadPoolExecutor, fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+
+class LoopLagMonitor:
+    """
+    Measures how long the event loop is blocked: a task sleeps `interval` seconds and
+    records by how much it woke up late. Stalls above LOOP_LAG_WARN_MS are logged.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+        self.stalls = 0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            t0 = loop.time()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (loop.time() - t0 - self.interval) * 1000)
+            self.last_ms = lag_ms
+            self.max_ms = max(self.max_ms, lag_ms)
+            if lag_ms >= LOOP_LAG_WARN_MS:
+                self.stalls += 1
+                log_error(f"[LOOP] Event loop blocked for {lag_ms:.0f} ms")
+
+    def summary(self) -> str:
+        return f"Loop lag: last {self.last_ms:.0f} ms, max {self.max_ms:.0f} ms, stalls>{LOOP_LAG_WARN_MS}ms: {self.stalls}"
+
+loop_lag = LoopLagMonitor()
+
+# =========================
+# Metrics (stage timings and counters; /metrics command and local HTTP endpoint)
+# =========================
+class StageStats:
+    """Cumulative histogram of one stage's durations plus a ring buffer of the latest samples."""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, window: int):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.recent: "deque[float]" = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        samples = sorted(self.recent)
+        return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+class Metrics:
+    """Thread-safe registry: stage timings, event counters and gauges read on demand."""
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._stages: Dict[str, StageStats] = {}
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            st = self._stages.get(stage)
+            if st is None:
+                st = self._stages[stage] = StageStats(self.window)
+            st.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Times the block (wall clock; inside a coroutine it includes the awaits)."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def inc(self, event: str, n: float = 1):
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + n
+
+    def counter(self, event: str) -> float:
+        with self._lock:
+            return self._counters.get(event, 0)
+
+    def quantile(self, stage: str, q: float, min_samples: int = 1) -> Optional[float]:
+        """q-quantile of the stage's recent window, or None with fewer than min_samples."""
+        with self._lock:
+            st = self._stages.get(stage)
+            if st is None or len(st.recent) < max(1, min_samples):
+                return None
+            return st.quantile(q)
+
+    def gauge(self, name: str, fn: Callable[[], float]):
+        self._gauges[name] = fn
+
+    def _gauge_values(self) -> Dict[str, float]:
+        out = {}
+        for name, fn in self._gauges.items():
+            try:
+                out[name] = float(fn())
+            except Exception:
+                pass
+        return out
+
+    def render_prometheus(self) -> str:
+        lines = ["# TYPE bmw_stage_seconds histogram"]
+        with self._lock:
+            for stage, st in sorted(self._stages.items()):
+                cum = 0
+                for bound, n in zip(StageStats.BUCKETS, st.counts):
+                    cum += n
+                    lines.append(f'bmw_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cum}')
+                lines.append(f'bmw_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {st.count}')
+                lines.append(f'bmw_stage_seconds_sum{{stage="{stage}"}} {st.total:.6f}')
+                lines.append(f'bmw_stage_seconds_count{{stage="{stage}"}} {st.count}')
+            lines.append("# TYPE bmw_stage_recent_seconds gauge")
+            for stage, st in sorted(self._stages.items()):
+                for q in (0.5, 0.95, 0.99):
+                    lines.append(f'bmw_stage_recent_seconds{{stage="{stage}",quantile="{q}"}} {st.quantile(q):.6f}')
+            lines.append("# TYPE bmw_events_total counter")
+            for event, n in sorted(self._counters.items()):
+                lines.append(f'bmw_events_total{{event="{event}"}} {n:g}')
+        lines.append("# TYPE bmw_gauge gauge")
+        for name, value in sorted(self._gauge_values().items()):
+            lines.append(f'bmw_gauge{{name="{name}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Compact table for the /metrics command: recent-window quantiles per stage, counters, gauges."""
+        lines = [f"{'stage':<16}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"]
+        with self._lock:
+            for stage, st in sorted(self._stages.items()):
+                lines.append(
+                    f"{stage:<16}{st.count:>7}{st.quantile(0.5):>8.3f}s{st.quantile(0.95):>8.3f}s"
+                    f"{st.quantile(0.99):>8.3f}s{max(st.recent, default=0.0):>8.3f}s"
+                )
+            counters = sorted(self._counters.items())
+        if counters:
+            lines.append("")
+            lines += [f"{event:<24}{n:>10g}" for event, n in counters]
+        gauges = sorted(self._gauge_values().items())
+        if gauges:
+            lines.append("")
+            lines += [f"{name:<24}{value:>10g}" for name, value in gauges]
+        return "\n".join(lines)
+
+metrics = Metrics()
+metrics.gauge("loop_lag_ms", lambda: loop_lag.last_ms)
+metrics.gauge("loop_lag_max_ms", lambda: loop_lag.max_ms)
+metrics.gauge("log_queue", lambda: _log_queue_handler.queue.qsize())
+metrics.gauge("log_enqueued", lambda: _log_queue_handler.enqueued)
+metrics.gauge("log_dropped", lambda: _log_queue_handler.dropped)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # keep scrapes out of app.log
+        pass
+
+def start_metrics_server() -> Optional[ThreadingHTTPServer]:
+    if METRICS_PORT <= 0:
+        return None
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _MetricsHandler)
+    except OSError as e:
+        log_error(f"[METRICS] Cannot listen on {METRICS_HOST}:{METRICS_PORT}", e)
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log_info(f"[METRICS] Serving http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
 # =========================
 # Utilities
 # =========================
@@ -135,12 +528,69 @@ def format_price(price) -> str:
     except Exception:
         return str(price)
 
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key: str, value, ttl: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+_image_cache = TTLCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_TTL)
+
 def check_image_url(url: str) -> bool:
+    ok = _image_cache.get(url)
+    if ok is not None:
+        return ok
     try:
-        resp = requests.head(url, timeout=5)
-        return resp.status_code == 200
+        with metrics.timer("image_probe"):
+            resp = http_session().head(url, timeout=5)
+        ok = resp.status_code == 200
     except Exception:
-        return False
+        ok = False
+    metrics.inc("image_probe_ok" if ok else "image_probe_failed")
+    _image_cache.set(url, ok, None if ok else IMAGE_NEGATIVE_TTL)
+    return ok
+
+async def resolve_image_url(lot: "Lot") -> Optional[str]:
+    """
+    First working image of the lot. Its candidates are probed in order on _probe_pool,
+    stopping at the first that works (the first usually does); lots run concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    for u in lot.images:
+        if await loop.run_in_executor(_probe_pool, check_image_url, u):
+            return u
+    return None
+
+async def prefetch_images(lots: Iterable["Lot"]) -> Dict[str, Optional[str]]:
+    """Warms the image cache for a batch of lots concurrently; returns {vssId: working image or None}."""
+    lots = list(lots)
+    with metrics.timer("image_prefetch"):
+        urls = await asyncio.gather(*(resolve_image_url(lot) for lot in lots), return_exceptions=True)
+    return {lot.vss_id: None if isinstance(url, BaseException) else url for lot, url in zip(lots, urls)}
 
 def car_url(vssId: str) -> str:
     return f"https://www.bmw.de/de-de/sl/gebrauchtwagen#/details/{vssId}"
@@ -188,13 +638,71 @@ def get_price(car: dict) -> int:
 def get_mileage(car: dict) -> int:
     return car["vehicleLifeCycle"]["mileage"]["km"]
 
-def format_car(car: dict):
-    vssId = car["vssId"]
-    model = get_model_text(car)
-    price = format_price(get_price(car))
-    mileage = get_mileage(car)
-    gearbox = get_gearbox(car)
-    fuel = get_fuel(car)
+def lot_fingerprint(car: dict) -> str:
+    """
+    Hash of the raw JSON behind the LOT_FIELDS columns (no localized-string normalization);
+    a hash change is confirmed by field_deltas before anything is written or sent.
+    """
+    mo = (car.get("vehicleSpecification") or {}).get("modelAndOption") or {}
+    src = [
+        mo.get("model"), mo.get("transmission"),
+        mo.get("baseFuelType"), mo.get("degreeOfElectrificationBasedFuelType"),
+        car.get("price"), ((car.get("vehicleLifeCycle") or {}).get("mileage") or {}).get("km"),
+    ]
+    raw = json.dumps(src, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+class Lot(NamedTuple):
+    """
+    Compact projection of a search hit with just the fields the bot uses.
+    Built once per hit while paginating; the raw vehicle JSON is not kept.
+    """
+    vss_id: str
+    model: str
+    price: int
+    mileage: int
+    gearbox: str
+    fuel: str
+    images: Tuple[str, ...]
+    fp: str
+
+    @classmethod
+    def from_vehicle(cls, car: dict) -> "Lot":
+        images = tuple(img["url"] for img in car.get("images") or [] if img.get("url"))
+        return cls(
+            vss_id=car["vssId"],
+            model=sys.intern(get_model_text(car)),
+            price=get_price(car),
+            mileage=get_mileage(car),
+            gearbox=sys.intern(get_gearbox(car)),
+            fuel=sys.intern(get_fuel(car)),
+            images=images[:MAX_IMAGE_CANDIDATES],
+            fp=lot_fingerprint(car),
+        )
+
+def project_hit(h: dict, cache: Optional[Dict[str, Lot]] = None) -> Optional[Lot]:
+    """Lot of a search hit; with a cycle-scoped cache a vehicle found by several searches is parsed once."""
+    vid = h.get("vehicle", {}).get("vssId")
+    if cache is not None:
+        lot = cache.get(vid)
+        if lot is not None:
+            return lot
+    try:
+        lot = Lot.from_vehicle(h["vehicle"])
+    except Exception as e:
+        log_error(f"[PARSE] Skipping malformed vehicle {vid}", e)
+        return None
+    if cache is not None:
+        cache[vid] = lot
+    return lot
+
+async def format_car(lot: Lot):
+    vssId = lot.vss_id
+    model = lot.model
+    price = format_price(lot.price)
+    mileage = lot.mileage
+    gearbox = lot.gearbox
+    fuel = lot.fuel
     url = car_url(vssId)
     msg = (
         f"<b>{model}</b>\n"
@@ -205,13 +713,7 @@ def format_car(car: dict):
         f"⛽️ <b>Fuel type:</b> {fuel}\n"
         f'<a href="{url}">Details</a>'
     )
-    img_url = None
-    if car.get("images"):
-        for img in car["images"]:
-            u = img.get("url")
-            if u and check_image_url(u):
-                img_url = u
-                break
+    img_url = await resolve_image_url(lot)
     return img_url, msg
 
 # =========================
@@ -229,42 +731,426 @@ def build_beta_filters() -> dict:
         "resultsContext": {"sort": [{"by": "PRODUCTION_DATE", "order": "DESC"}]}
     }
 
-def get_all_bmw_lots(data: dict, max_per_page: int = 100) -> List[dict]:
-    url_base = "https://stolo-data-service.prod.stolo.eu-central-1.aws.bmw.cloud/vehiclesearch/search/de-de/gebrauchtwagen"
-    headers = {
-        "user-agent": "Mozilla/5.0",
-        "content-type": "application/json",
-        "origin": "https://www.bmw.de",
-        "referer": "https://www.bmw.de/",
-    }
+class SearchProfile(NamedTuple):
+    """A saved search: request body, chats to alert and the sheet tab it is mirrored to."""
+    name: str
+    data: dict
+    chat_ids: Tuple[int, ...]
+    sheet_tab: str  # '' = first worksheet
 
+def load_profiles(path: str = PROFILES_FILE) -> List[SearchProfile]:
+    """
+    Profiles from a JSON list of {"name", "searchContext", ["resultsContext"], ["chat_ids"], ["sheet_tab"]}.
+    Without the file there is a single "default" profile: build_beta_filters() -> CHAT_IDS, first sheet.
+    """
+    if not os.path.exists(path):
+        return [SearchProfile("default", build_beta_filters(), tuple(CHAT_IDS), "")]
+    with open(path, encoding="utf-8") as f:
+        items = json.load(f)
+    default_results = build_beta_filters()["resultsContext"]
+    profiles: List[SearchProfile] = []
+    for item in items:
+        ctx = item["searchContext"]
+        data = {
+            "searchContext": ctx if isinstance(ctx, list) else [ctx],
+            "resultsContext": item.get("resultsContext") or default_results,
+        }
+        chat_ids = tuple(int(c) for c in item.get("chat_ids") or CHAT_IDS)
+        profiles.append(SearchProfile(item["name"], data, chat_ids, item.get("sheet_tab", "")))
+    names = [p.name for p in profiles]
+    if not profiles or len(set(names)) != len(names):
+        raise ValueError(f"{path}: profile names must be present and unique")
+    return profiles
+
+BMW_SEARCH_URL = "https://stolo-data-service.prod.stolo.eu-central-1.aws.bmw.cloud/vehiclesearch/search/de-de/gebrauchtwagen"
+BMW_HEADERS = {
+    "user-agent": "Mozilla/5.0",
+    "content-type": "application/json",
+    "origin": "https://www.bmw.de",
+    "referer": "https://www.bmw.de/",
+}
+
+_http: Optional[requests.Session] = None
+
+def http_session() -> requests.Session:
+    """Shared keep-alive session; the pool is sized for every request thread (hedges included)."""
+    global _http
+    if _http is None:
+        s = requests.Session()
+        s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(10, _request_pool._max_workers)))
+        s.headers.update(BMW_HEADERS)
+        _http = s
+    return _http
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class BmwApiError(Exception):
+    """A search page could not be fetched within PAGE_MAX_RETRIES retries."""
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter: uniform(0, min(RETRY_MAX_DELAY, base * 2^attempt))."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def retry_after_seconds(resp) -> Optional[float]:
+    """Retry-After header (delta-seconds or HTTP date) in seconds, or None."""
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class ApiCooldown:
+    """Pause shared by all fetch threads after a 429/Retry-After, so they back off together."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._until = 0.0
+
+    def hold(self, seconds: float):
+        with self._lock:
+            self._until = max(self._until, time.monotonic() + seconds)
+
+    def remaining(self) -> float:
+        return max(0.0, self._until - time.monotonic())
+
+    def wait(self):
+        while (left := self.remaining()) > 0:
+            time.sleep(left)
+
+api_cooldown = ApiCooldown()
+
+class CircuitOpenError(BmwApiError):
+    """The search API's circuit breaker is open: the request was not sent."""
+
+class CircuitBreaker:
+    """
+    Closed: requests flow, and `threshold` failures in a row open the breaker. Open: requests
+    fail fast with CircuitOpenError until `reset` seconds have passed. Half-open: a single probe
+    goes through; its success closes the breaker, its failure reopens it for twice as long.
+    Thread-safe: every fetch thread reports to the same breaker.
+    """
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(self, name: str, threshold: int = BREAKER_FAILURES, reset: float = BREAKER_RESET,
+                 max_reset: float = BREAKER_MAX_RESET):
+        self.name = name
+        self.threshold = threshold
+        self.reset = reset
+        self.max_reset = max(reset, max_reset)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.timeout = reset
+        self._opened = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now (in half-open state: whether it is the probe)."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened < self.timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                log_info(f"[BREAKER] {self.name}: half-open, sending a probe")
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                log_info(f"[BREAKER] {self.name}: closed, API answers again")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.timeout = self.reset
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.timeout = min(self.max_reset, self.timeout * 2)
+                self._open()
+            elif self.state == self.CLOSED and self.failures >= self.threshold:
+                self._open()
+            self._probing = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened = time.monotonic()
+        metrics.inc("api_breaker_open")
+        log_error(f"[BREAKER] {self.name}: open after {self.failures} failure(s), next probe in {self.timeout:.0f}s")
+
+    def retry_in(self) -> float:
+        """Seconds until a probe may be sent (0 unless open)."""
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0.0
+            return max(0.0, self._opened + self.timeout - time.monotonic())
+
+api_breaker = CircuitBreaker("search API")
+
+class HedgeBudget:
+    """
+    HEDGE_MAX_RATIO enforced over the last `window` requests and hedges: an allowance left
+    unused in quiet hours cannot be spent all at once when the API slows down.
+    """
+
+    def __init__(self, ratio: float, window: int = HEDGE_WINDOW):
+        self.ratio = ratio
+        self._lock = threading.Lock()
+        self._recent: deque = deque(maxlen=window)  # True = hedge, False = request
+        self._hedges = 0
+
+    def _record(self, hedge: bool):
+        if len(self._recent) == self._recent.maxlen:
+            self._hedges -= self._recent[0]
+        self._recent.append(hedge)
+        self._hedges += hedge
+
+    def _allows(self) -> bool:
+        return self._hedges < self.ratio * (len(self._recent) - self._hedges)
+
+    def request(self):
+        with self._lock:
+            self._record(False)
+
+    def allows(self) -> bool:
+        with self._lock:
+            return self._allows()
+
+    def spend(self) -> bool:
+        """Takes one hedge from the budget; False if it is used up."""
+        with self._lock:
+            if not self._allows():
+                return False
+            self._record(True)
+            return True
+
+hedge_budget = HedgeBudget(HEDGE_MAX_RATIO)
+metrics.gauge("api_breaker_state", lambda: api_breaker.state)
+
+def post_once(url: str, data: dict) -> requests.Response:
+    """One search request, timed into the api_page latency window and reported to the breaker."""
+    t0 = time.perf_counter()
+    try:
+        resp = http_session().post(url, json=data, timeout=API_TIMEOUT)
+    except requests.RequestException:
+        api_breaker.failure()
+        raise
+    finally:
+        metrics.observe("api_page", time.perf_counter() - t0)
+    # 429 and other 4xx mean the API is up; throttling is ApiCooldown's business
+    if resp.status_code >= 500:
+        api_breaker.failure()
+    else:
+        api_breaker.success()
+    return resp
+
+def hedge_delay() -> Optional[float]:
+    """How long a search request may run before it is hedged; None = not now."""
+    if HEDGE_MAX_RATIO <= 0 or api_breaker.state != CircuitBreaker.CLOSED:
+        return None
+    if not hedge_budget.allows():
+        return None
+    q = metrics.quantile("api_page", HEDGE_QUANTILE, HEDGE_MIN_SAMPLES)
+    return None if q is None else max(HEDGE_MIN_DELAY, q)
+
+def post_hedged(url: str, data: dict) -> requests.Response:
+    """
+    post_once, plus a duplicate request if the first one is still running after hedge_delay().
+    The first response wins (the search is a read, so the duplicate is harmless); the loser
+    runs to completion in the background. Raises only if both requests fail.
+    """
+    metrics.inc("api_request")
+    hedge_budget.request()
+    primary = _request_pool.submit(post_once, url, data)
+    delay = hedge_delay()
+    if delay is None or wait([primary], timeout=delay).done:
+        return primary.result()
+    if hedge_delay() is None or not hedge_budget.spend():  # the budget may have been used up meanwhile
+        return primary.result()
+    metrics.inc("api_hedge")
+    hedge = _request_pool.submit(post_once, url, data)
+    pending = {primary, hedge}
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in done:
+            try:
+                resp = fut.result()
+            except requests.RequestException as e:
+                error = error or e
+                continue
+            if fut is hedge:
+                metrics.inc("api_hedge_won")
+            return resp
+    raise error
+
+class PageEntry(NamedTuple):
+    """A result page as last received: digest of the raw body, a slim copy of its JSON and its Lots."""
+    digest: bytes
+    slim: Optional[dict]  # totalResults and a vssId stub per hit, shaped like the response
+    lots: Optional[List[Lot]]
+
+_page_cache = TTLCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+metrics.gauge("page_cache_size", lambda: len(_page_cache))
+
+def page_key(data: dict, start_index: int, max_per_page: int) -> str:
+    raw = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(f"{raw}|{start_index}|{max_per_page}".encode(), digest_size=16).hexdigest()
+
+def decode_page(key: str, content: bytes) -> dict:
+    """
+    JSON of a result page. A body identical to the one parsed last time for this key is not
+    decoded: a copy of the cached slim JSON comes back instead, carrying the parsed Lots under
+    "_lots" for page_lots(), so the page stays usable if the entry expires before it is consumed.
+    """
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    entry = _page_cache.get(key)
+    if entry is not None and entry.digest == digest and entry.lots is not None:
+        metrics.inc("page_cache_hit")
+        return {**entry.slim, "_lots": entry.lots}
+    metrics.inc("page_cache_miss")
+    j = json.loads(content)
+    _page_cache.set(key, PageEntry(digest, None, None))  # completed by page_lots once parsed
+    return j
+
+def page_lots(key: str, j: dict, lot_cache: Optional[Dict[str, Lot]] = None) -> List[Lot]:
+    """Lots of a decoded page in hit order (not deduplicated); parsed once per distinct body."""
+    cached = j.get("_lots")
+    if cached is not None:
+        if lot_cache is not None:
+            for lot in cached:
+                lot_cache.setdefault(lot.vss_id, lot)
+        return cached
+    entry = _page_cache.get(key)
+    hits = j.get("hits") or []
+    lots = [lot for lot in (project_hit(h, lot_cache) for h in hits if h.get("vehicle", {}).get("vssId")) if lot]
+    if entry is not None and entry.slim is None:
+        # one stub per hit, id-less ones included: a cache hit must paginate on the same hit
+        # count and first id as the response it replaces
+        slim = {"totalResults": page_total(j),
+                "hits": [{"vehicle": {"vssId": h.get("vehicle", {}).get("vssId")}} for h in hits]}
+        _page_cache.set(key, entry._replace(slim=slim, lots=lots))
+    return lots
+
+def fetch_bmw_page(data: dict, start_index: int, max_per_page: int, quiet: bool = False) -> Optional[dict]:
+    """
+    One search page as JSON, or None on a non-retryable HTTP status.
+    429/5xx and network errors are retried up to PAGE_MAX_RETRIES times, then BmwApiError is raised;
+    while the circuit breaker is open it raises CircuitOpenError without sending anything.
+    """
+    url = f"{BMW_SEARCH_URL}?maxResults={max_per_page}&startIndex={start_index}&brand=BMW&context=results-page"
+    error = ""
+    for attempt in range(PAGE_MAX_RETRIES + 1):
+        api_cooldown.wait()
+        if not api_breaker.allow():
+            metrics.inc("api_breaker_rejected")
+            raise CircuitOpenError(f"startIndex={start_index}: circuit open, next probe in {api_breaker.retry_in():.0f}s")
+        if not quiet:
+            log_info(f"BMW API: startIndex={start_index}, page={start_index // max_per_page + 1}")
+        throttled = False
+        try:
+            resp = post_hedged(url, data)
+        except requests.RequestException as e:
+            metrics.inc("api_network_error")
+            error = f"{type(e).__name__}: {e}"
+            delay = backoff_delay(attempt)
+        else:
+            metrics.inc(f"api_http_{resp.status_code}")
+            if resp.status_code in (200, 201):
+                return decode_page(page_key(data, start_index, max_per_page), resp.content)
+            log_error(f"BMW API: {resp.status_code} {resp.text[:300]}")
+            if resp.status_code not in RETRYABLE_STATUS:
+                return None
+            error = f"HTTP {resp.status_code}"
+            retry_after = retry_after_seconds(resp)
+            throttled = resp.status_code == 429 or retry_after is not None
+            if retry_after is not None:
+                # small jitter so the waiting threads do not all fire at the same instant
+                delay = min(RETRY_MAX_DELAY, retry_after) + random.uniform(0, 1)
+            else:
+                delay = backoff_delay(attempt + (2 if throttled else 0))
+        if attempt == PAGE_MAX_RETRIES:
+            break
+        log_info(f"BMW API: {error}, retry {attempt + 1}/{PAGE_MAX_RETRIES} in {delay:.1f}s")
+        metrics.inc("api_retry")
+        if throttled:
+            api_cooldown.hold(delay)
+        else:
+            time.sleep(delay)
+    raise BmwApiError(f"startIndex={start_index}: {error}, {PAGE_MAX_RETRIES} retries exhausted")
+
+def fetch_bmw_pages(data: dict, pages: Iterable[int], max_per_page: int, into: Dict[int, Optional[dict]],
+                    quiet: bool = False):
+    """
+    Fetches pages concurrently (at most FETCH_CONCURRENCY in flight) into `into` {page: json}.
+    Successful pages are kept even if another one fails; the first error is re-raised.
+    """
+    futures = {_fetch_pool.submit(fetch_bmw_page, data, p * max_per_page, max_per_page, quiet): p for p in pages}
+    error: Optional[Exception] = None
+    for fut in as_completed(futures):
+        try:
+            into[futures[fut]] = fut.result()
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+
+def get_all_bmw_lots(data: dict, max_per_page: int = 100, first_page: Optional[dict] = None,
+                     on_page: Optional[Callable[[List[Lot]], None]] = None,
+                     lot_cache: Optional[Dict[str, Lot]] = None) -> List[Lot]:
+    """
+    All lots of a search. Pages are consumed in order as soon as each one arrives;
+    on_page (if given) receives every page's new lots right away, from this thread.
+    Raises BmwApiError if a page keeps failing: an incomplete result must not look like removals.
+    """
     MAX_PAGES = 50
-    all_hits: List[dict] = []
+    all_lots: List[Lot] = []
     seen_ids: Set[str] = set()
-    start_index = 0
     total_expected: Optional[int] = None
     last_first_id: Optional[str] = None
+    fetched: Dict[int, Optional[dict]] = {} if first_page is None else {0: first_page}
+    inflight: Dict[int, Future] = {}
     page = 0
 
+    def submit(p: int):
+        return _fetch_pool.submit(fetch_bmw_page, data, p * max_per_page, max_per_page)
+
     for attempt in range(MAX_RETRIES):
         try:
             while page < MAX_PAGES:
-                url = f"{url_base}?maxResults={max_per_page}&startIndex={start_index}&brand=BMW&context=results-page"
-                log_info(f"BMW API: startIndex={start_index}, page={page+1}")
-
-                resp = requests.post(url, headers=headers, json=data, timeout=30)
-                if resp.status_code not in (200, 201):
-                    log_error(f"BMW API: {resp.status_code} {resp.text[:300]}")
-                    if resp.status_code == 502:
-                        time.sleep(5)
-                        continue
-                    break
-
-                j = resp.json()
+                if page not in fetched:
+                    if page > 0 and total_expected:
+                        # total is known after the first page -> request the rest in parallel
+                        last_page = min(MAX_PAGES, -(-int(total_expected) // max_per_page))
+                        for p in range(page, last_page):
+                            if p not in fetched and p not in inflight:
+                                inflight[p] = submit(p)
+                    fut = inflight.pop(page, None) or submit(page)
+                    fetched[page] = fut.result()
+
+                j = fetched.pop(page)
+                if j is None:
+                    if page > 0:
+                        # a page refused mid-search (403 from a WAF, 400 on a deep offset, ...):
+                        # the lots after it would look removed
+                        raise BmwApiError(f"startIndex={page * max_per_page}: non-retryable response")
+                    break  # no first page: full_sweep's empty-result guard applies
                 hits = j.get("hits", []) or []
 
                 if total_expected is None:
-                    total_expected = j.get("totalResults") or j.get("total") or (j.get("pagination") or {}).get("total")
+                    total_expected = page_total(j)
                     if total_expected:
                         log_info(f"BMW API: total_expected={total_expected}")
 
@@ -278,51 +1164,228 @@ def get_all_bmw_lots(data: dict, max_per_page: int = 100) -> List[dict]:
                     break
                 last_first_id = first_id
 
-                new_unique = 0
-                for h in hits:
-                    vid = h.get("vehicle", {}).get("vssId")
-                    if not vid or vid in seen_ids:
-                        continue
-                    seen_ids.add(vid)
-                    all_hits.append(h)
-                    new_unique += 1
+                fresh: List[Lot] = []
+                for lot in page_lots(page_key(data, page * max_per_page, max_per_page), j, lot_cache):
+                    if lot.vss_id not in seen_ids:
+                        seen_ids.add(lot.vss_id)
+                        fresh.append(lot)
+                all_lots.extend(fresh)
+                if on_page and fresh:
+                    on_page(fresh)
 
-                log_info(f" [+] Unique on page: {new_unique}, total: {len(all_hits)}")
+                log_info(f" [+] Unique on page: {len(fresh)}, total: {len(all_lots)}")
 
                 if len(hits) < max_per_page:
                     log_info("BMW API: last page (< max_per_page) -> stop")
                     break
-                if total_expected and len(all_hits) >= total_expected:
+                if total_expected and len(seen_ids) >= total_expected:
                     log_info("BMW API: reached total_expected -> stop")
                     break
 
-                start_index += max_per_page
                 page += 1
             break
+        except BmwApiError:
+            # the page already used up its own retries
+            for fut in inflight.values():
+                fut.cancel()
+            raise
         except Exception as e:
             log_error(f"BMW API: attempt {attempt+1}/{MAX_RETRIES} failed", e)
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(10)
+            if attempt == MAX_RETRIES - 1:
+                for fut in inflight.values():
+                    fut.cancel()
+                raise BmwApiError(f"all {MAX_RETRIES} attempts failed") from e
+            time.sleep(backoff_delay(attempt + 1))
+    for fut in inflight.values():  # pages past an early stop
+        fut.cancel()
+    return all_lots
+
+def get_head_bmw_lots(data: dict, pages: int = HEAD_PAGES, max_per_page: int = 100,
+                      lot_cache: Optional[Dict[str, Lot]] = None) -> List[Lot]:
+    """
+    Top `pages` pages only (results are sorted PRODUCTION_DATE DESC, so new arrivals land here).
+    Used by the fast poll. Errors (CircuitOpenError included) are raised, so a failed poll
+    is not mistaken for a quiet one.
+    """
+    fetched: Dict[int, Optional[dict]] = {}
+    fetch_bmw_pages(data, range(pages), max_per_page, fetched, quiet=True)
+    if not fetched.get(0):
+        raise BmwApiError("head page: no usable response")
+    lots: List[Lot] = []
+    seen_ids: Set[str] = set()
+    for p in range(pages):
+        j = fetched.pop(p, None)
+        if not j:
+            continue
+        for lot in page_lots(page_key(data, p * max_per_page, max_per_page), j, lot_cache):
+            if lot.vss_id not in seen_ids:
+                seen_ids.add(lot.vss_id)
+                lots.append(lot)
+    return lots
+
+# =========================
+# Search partitioning (disjoint shards, shallow offsets)
+# =========================
+def page_total(j: Optional[dict]) -> Optional[int]:
+    if not j:
+        return None
+    return j.get("totalResults") or j.get("total") or (j.get("pagination") or {}).get("total")
+
+def shard_range(data: dict, kind: str) -> Optional[Tuple]:
+    """(min, max) of the partitioned filter in the first searchContext, or None if it is not set."""
+    ctx = (data.get("searchContext") or [{}])[0]
+    if kind == "date":
+        ranges = ctx.get("initialRegistrationDateRanges") or []
+    elif kind == "mileage":
+        ranges = (ctx.get("usedCarData") or {}).get("mileageRanges") or []
+    else:
+        return None
+    if len(ranges) != 1 or "minValue" not in ranges[0] or "maxValue" not in ranges[0]:
+        return None
+    return ranges[0]["minValue"], ranges[0]["maxValue"]
+
+def with_shard_range(data: dict, kind: str, lo, hi) -> dict:
+    d = copy.deepcopy(data)
+    ctx = d["searchContext"][0]
+    if kind == "date":
+        ctx["initialRegistrationDateRanges"] = [{"minValue": lo, "maxValue": hi}]
+    else:
+        ctx.setdefault("usedCarData", {})["mileageRanges"] = [{"minValue": lo, "maxValue": hi}]
+    return d
+
+def split_shard_range(kind: str, lo, hi) -> Optional[List[Tuple]]:
+    """Two disjoint inclusive halves of [lo, hi], or None if the range cannot be split further."""
+    if kind == "date":
+        a, b = date.fromisoformat(lo), date.fromisoformat(hi)
+        if a >= b:
+            return None
+        mid = a + timedelta(days=(b - a).days // 2)
+        return [(a.isoformat(), mid.isoformat()), ((mid + timedelta(days=1)).isoformat(), b.isoformat())]
+    a, b = int(lo), int(hi)
+    if a >= b:
+        return None
+    mid = (a + b) // 2
+    return [(a, mid), (mid + 1, b)]
+
+def plan_shards(data: dict, kind: str, max_per_page: int = 100) -> List[Tuple[dict, dict]]:
+    """
+    Splits the search until every shard has at most SHARD_MAX_RESULTS results.
+    Returns [(shard_data, first_page_json)]; the first page is reused by the shard fetch.
+    """
+    rng = shard_range(data, kind)
+    if rng is None:
+        log_error(f"[SHARD] searchContext has no single {kind} range - partitioning disabled")
+        return [(data, None)]
+
+    leaves: List[Tuple[dict, dict]] = []
+    error: Optional[Exception] = None
+    frontier = [(rng[0], rng[1])]
+    while frontier:
+        futures = {
+            _shard_pool.submit(fetch_bmw_page, with_shard_range(data, kind, lo, hi), 0, max_per_page): (lo, hi)
+            for lo, hi in frontier
+        }
+        frontier = []
+        for fut in as_completed(futures):
+            lo, hi = futures[fut]
+            try:
+                j = fut.result()
+            except Exception as e:
+                log_error(f"[SHARD] {kind} {lo}..{hi}: probe failed", e)
+                error = error or e
+                continue
+            if j is None:
+                continue
+            total = page_total(j)
+            halves = split_shard_range(kind, lo, hi) if total and total > SHARD_MAX_RESULTS else None
+            if halves:
+                log_info(f"[SHARD] {kind} {lo}..{hi}: total={total} -> split")
+                frontier.extend(halves)
             else:
-                log_error("BMW API: all attempts exhausted - returning collected")
-                return all_hits
-    return all_hits
-
-def extract_id_dict_from_hits(hits: List[dict]) -> Dict[str, dict]:
-    out: Dict[str, dict] = {}
-    for h in hits:
-        v = h.get("vehicle")
-        if v and "vssId" in v:
-            out[v["vssId"]] = v
-    return out
+                if total and total > SHARD_MAX_RESULTS:
+                    log_error(f"[SHARD] {kind} {lo}..{hi}: total={total} but range cannot be split further")
+                leaves.append((with_shard_range(data, kind, lo, hi), j))
+    if error is not None:
+        raise error  # a missing shard would look like removed lots
+    leaves.sort(key=lambda x: shard_range(x[0], kind))
+    log_info(f"[SHARD] {len(leaves)} shard(s) by {kind}")
+    return leaves
+
+def get_partitioned_bmw_lots(data: dict, kind: str, max_per_page: int = 100,
+                             on_page: Optional[Callable[[List[Lot]], None]] = None,
+                             lot_cache: Optional[Dict[str, Lot]] = None) -> List[Lot]:
+    """Fetches all shards in parallel and merges their lots by vssId; the first shard error is re-raised."""
+    shards = plan_shards(data, kind, max_per_page)
+    futures = [
+        _shard_pool.submit(get_all_bmw_lots, shard, max_per_page, first_page, on_page, lot_cache)
+        for shard, first_page in shards
+    ]
+    merged: Dict[str, Lot] = {}
+    error: Optional[Exception] = None
+    for fut in futures:
+        try:
+            for lot in fut.result():
+                merged.setdefault(lot.vss_id, lot)
+        except Exception as e:
+            log_error("[SHARD] shard fetch failed", e)
+            error = error or e
+    log_info(f"[SHARD] merged unique: {len(merged)}")
+    if error is not None:
+        raise error
+    return list(merged.values())
+
+def fetch_lots(data: dict, on_page: Optional[Callable[[List[Lot]], None]] = None,
+               lot_cache: Optional[Dict[str, Lot]] = None) -> List[Lot]:
+    with metrics.timer("fetch"):
+        if SEARCH_PARTITION in ("date", "mileage"):
+            return get_partitioned_bmw_lots(data, SEARCH_PARTITION, on_page=on_page, lot_cache=lot_cache)
+        return get_all_bmw_lots(data, on_page=on_page, lot_cache=lot_cache)
+
+async def stream_lots(data: dict, lot_cache: Optional[Dict[str, Lot]] = None) -> AsyncIterator[List[Lot]]:
+    """
+    Runs fetch_lots on _api_pool and yields each page's lots as soon as it is parsed.
+    Pages of different shards may interleave and repeat vssIds; the end of the
+    iteration is the end-of-stream barrier (the sweep is complete).
+    """
+    loop = asyncio.get_running_loop()
+    q: asyncio.Queue = asyncio.Queue()
+    fut = loop.run_in_executor(_api_pool, functools.partial(
+        fetch_lots, data, lambda lots: loop.call_soon_threadsafe(q.put_nowait, lots), lot_cache
+    ))
+    fut.add_done_callback(lambda _: q.put_nowait(None))
+    while True:
+        lots = await q.get()
+        if lots is None:
+            break
+        yield lots
+    await fut
+
+def lots_by_id(lots: List[Lot]) -> Dict[str, Lot]:
+    return {lot.vss_id: lot for lot in lots}
 
 def compare_ids(old_ids: Set[str], new_ids: Set[str]) -> Tuple[Set[str], Set[str]]:
     return new_ids - old_ids, old_ids - new_ids
 
+def diff_page(old_fps: Dict[str, Optional[str]], page: Dict[str, Lot]) -> Tuple[Dict[str, Lot], Dict[str, Lot]]:
+    """(added, changed) lots of one page against the stored fingerprints; removals need the whole sweep."""
+    added = {v: lot for v, lot in page.items() if v not in old_fps}
+    changed = {v: lot for v, lot in page.items() if v in old_fps and old_fps[v] != lot.fp}
+    return added, changed
+
+def field_deltas(old_row: list, new_row: list) -> Dict[str, Tuple]:
+    """{field: (old, new)} for the LOT_FIELDS that differ between two sheet rows."""
+    deltas: Dict[str, Tuple] = {}
+    for name in LOT_FIELDS:
+        i = SHEET_COLUMNS.index(name)
+        old = old_row[i] if i < len(old_row) else ""
+        if str(old) != str(new_row[i]):
+            deltas[name] = (old, new_row[i])
+    return deltas
+
 # =========================
 # Google Sheets helpers
 # =========================
-def gs_open_sheet():
+def gs_open_spreadsheet():
     import gspread
     from google.oauth2.service_account import Credentials
     creds = Credentials.from_service_account_file(GS_CRED, scopes=[
@@ -330,34 +1393,119 @@ def gs_open_sheet():
         'https://www.googleapis.com/auth/drive'
     ])
     gc = gspread.authorize(creds)
-    return gc.open(GSHEET_NAME).sheet1
-
-def sheet_index_by_vssid(sheet) -> Dict[str, int]:
-    values = sheet.get_all_values()
-    if not values:
-        return {}
-    header = {name.strip(): i for i, name in enumerate(values[0])}
-    if "vssId" not in header:
-        log_error("In the Google Sheet header there is no column 'vssId'")
-        return {}
-    col = header["vssId"]
-    idx: Dict[str, int] = {}
-    for r, row in enumerate(values[1:], start=2):
-        if col < len(row):
-            v = (row[col] or "").strip()
+    return gc.open(GSHEET_NAME)
+
+class SheetBook:
+    """Spreadsheet with cached worksheets by tab name; tab '' is the first sheet."""
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self._tabs: Dict[str, object] = {}
+        self.snapshots: Dict[str, Tuple["SheetSnapshot", float]] = {}  # tab -> (contents, read at)
+
+    def tab(self, name: str):
+        ws = self._tabs.get(name)
+        if ws is None:
+            if not name:
+                ws = self.spreadsheet.sheet1
+            else:
+                from gspread.exceptions import WorksheetNotFound
+                try:
+                    ws = self.spreadsheet.worksheet(name)
+                except WorksheetNotFound:
+                    ws = self.spreadsheet.add_worksheet(title=name, rows=1000, cols=len(SHEET_COLUMNS))
+                    ws.append_row(SHEET_COLUMNS, value_input_option="RAW")
+                    log_info(f"[GSHEET] Created tab '{name}'")
+            self._tabs[name] = ws
+        return ws
+
+def gs_open_book() -> SheetBook:
+    return SheetBook(gs_open_spreadsheet())
+
+class SheetSnapshot:
+    """
+    In-memory copy of the worksheet from a single get_all_values() call.
+    Header map, vssId index, duplicates and incomplete rows are all derived from it;
+    SheetWriter.flush() keeps it in step with the mutations it sends, which lets
+    tab_snapshot() reuse it across sync passes and restarts.
+    Row numbers are 1-based sheet rows (the header is row 1).
+    """
+
+    def __init__(self, values: List[list]):
+        self.header: Dict[str, int] = {name.strip(): i for i, name in enumerate(values[0])} if values else {}
+        self.rows: List[list] = [list(r) for r in values[1:]]
+
+    @classmethod
+    def read(cls, sheet) -> "SheetSnapshot":
+        with metrics.timer("sheet_snapshot"):
+            return cls(sheet.get_all_values())
+
+    def values(self) -> List[list]:
+        """Back to get_all_values() shape (header first), e.g. for the checkpoint."""
+        header = [""] * len(self.header)
+        for name, i in self.header.items():
+            header[i] = name
+        return [header] + self.rows
+
+    def vssid_col(self) -> Optional[int]:
+        col = self.header.get("vssId")
+        if col is None and self.header:
+            log_error("In the Google Sheet header there is no column 'vssId'")
+        return col
+
+    def iter_vssids(self):
+        """(row number, vssId) for every row with a non-empty vssId."""
+        col = self.vssid_col()
+        if col is None:
+            return
+        for r, row in enumerate(self.rows, start=2):
+            v = (row[col] if col < len(row) else "").strip()
             if v:
-                idx[v] = r
-    return idx
+                yield r, v
+
+    def index(self) -> Dict[str, int]:
+        """{vssId: row} of the first instance, the one dedupe keeps."""
+        idx: Dict[str, int] = {}
+        for r, v in self.iter_vssids():
+            idx.setdefault(v, r)
+        return idx
+
+    def duplicates(self) -> List[int]:
+        seen: Set[str] = set()
+        dups: List[int] = []
+        for r, v in self.iter_vssids():
+            if v in seen:
+                dups.append(r)
+            else:
+                seen.add(v)
+        return dups
+
+    def incomplete(self) -> List[Tuple[int, str]]:
+        return [(r, v) for r, v in self.iter_vssids() if row_is_incomplete(self.rows[r - 2], self.header)]
+
+    def row(self, r: int) -> list:
+        return self.rows[r - 2]
+
+    def apply(self, updates: Dict[int, list], deletes: Iterable[int], appends: List[list]):
+        for r, row in updates.items():
+            self.rows[r - 2] = [str(c) for c in row]
+        for r in sorted(deletes, reverse=True):
+            del self.rows[r - 2]
+        self.rows.extend([str(c) for c in row] for row in appends)
+
+def sheet_index_by_vssid(sheet, snap: Optional[SheetSnapshot] = None) -> Dict[str, int]:
+    return (snap or SheetSnapshot.read(sheet)).index()
 
-def header_index_map(sheet) -> dict:
-    values = sheet.get_all_values()
-    if not values:
-        return {}
-    return {name.strip(): i for i, name in enumerate(values[0])}
+def header_index_map(sheet, snap: Optional[SheetSnapshot] = None) -> dict:
+    return (snap or SheetSnapshot.read(sheet)).header
+
+def sheet_rows_by_vssid(sheet, snap: Optional[SheetSnapshot] = None) -> Dict[str, list]:
+    """{vssId: row A..H} for every sheet row (first instance wins)."""
+    snap = snap or SheetSnapshot.read(sheet)
+    return {v: (snap.row(r) + [""] * 8)[:8] for v, r in snap.index().items()}
 
 def row_is_incomplete(row: list, hmap: dict) -> bool:
-    need = ["vssId","model","price","mileage","gearbox","fuel","url","date_added"]
-    for key in need:
+    for key in SHEET_COLUMNS:
         idx = hmap.get(key)
         if idx is None or idx >= len(row):
             return True
@@ -365,80 +1513,1133 @@ def row_is_incomplete(row: list, hmap: dict) -> bool:
             return True
     return False
 
-def build_full_row(car: dict) -> list:
+def build_full_row(lot: Lot) -> list:
     return [
-        car["vssId"],
-        get_model_text(car),
-        get_price(car),
-        get_mileage(car),
-        get_gearbox(car),
-        get_fuel(car),
-        car_url(car["vssId"]),
+        lot.vss_id,
+        lot.model,
+        lot.price,
+        lot.mileage,
+        lot.gearbox,
+        lot.fuel,
+        car_url(lot.vss_id),
         datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     ]
 
-def update_row_A_H(sheet, row_idx: int, car: dict):
-    sheet.update(range_name=f"A{row_idx}:H{row_idx}", values=[build_full_row(car)], value_input_option="RAW")
+class SheetWriter:
+    """
+    Collects sheet mutations and sends them in a minimal number of requests on flush():
+    one multi-range values update, one batchUpdate with the deletions coalesced into
+    contiguous ranges, and one append. Row numbers always refer to the sheet as it was
+    before the flush, so callers can queue everything against a single read.
+    A snapshot passed in is updated locally after the flush instead of being re-read.
+    """
 
-def add_or_update_row_to_sheet(sheet, car: dict, sheet_idx: Dict[str, int]):
-    v = car["vssId"]
-    if v in sheet_idx and sheet_idx[v] > 1:
-        update_row_A_H(sheet, sheet_idx[v], car)
-    else:
-        sheet.append_row(build_full_row(car), value_input_option="RAW")
+    def __init__(self, sheet, snapshot: Optional["SheetSnapshot"] = None):
+        self.sheet = sheet
+        self.snapshot = snapshot
+        self._updates: Dict[int, list] = {}
+        self._deletes: Set[int] = set()
+        self._appends: List[list] = []
 
-def repair_incomplete_rows(sheet, new_dict: dict) -> int:
-    values = sheet.get_all_values()
-    if not values:
-        return 0
-    hmap = header_index_map(sheet)
+    def update_row(self, row_idx: int, row: list):
+        self._updates[row_idx] = row
+
+    def delete_row(self, row_idx: int):
+        self._deletes.add(row_idx)
+
+    def append_row(self, row: list):
+        self._appends.append(row)
+
+    def pending(self) -> bool:
+        return bool(self._updates or self._deletes or self._appends)
+
+    @staticmethod
+    def delete_ranges(rows: Iterable[int]) -> List[Tuple[int, int]]:
+        """Contiguous (start, end) row ranges, bottom-up so earlier deletions don't shift later ones."""
+        ranges: List[Tuple[int, int]] = []
+        for r in sorted(rows):
+            if ranges and ranges[-1][1] == r - 1:
+                ranges[-1] = (ranges[-1][0], r)
+            else:
+                ranges.append((r, r))
+        return ranges[::-1]
+
+    def flush(self) -> int:
+        """Sends queued mutations; returns the number of API requests made."""
+        with metrics.timer("sheet_write"):
+            requests_made = self._flush()
+        metrics.inc("sheet_requests", requests_made)
+        return requests_made
+
+    def _flush(self) -> int:
+        requests_made = 0
+        updates = {r: row for r, row in self._updates.items() if r not in self._deletes}
+        if updates:
+            self.sheet.batch_update(
+                [{"range": f"A{r}:H{r}", "values": [row]} for r, row in sorted(updates.items())],
+                value_input_option="RAW",
+            )
+            requests_made += 1
+        if self._deletes:
+            ranges = self.delete_ranges(self._deletes)
+            self.sheet.spreadsheet.batch_update({"requests": [
+                {"deleteDimension": {"range": {
+                    "sheetId": self.sheet.id, "dimension": "ROWS", "startIndex": start - 1, "endIndex": end,
+                }}}
+                for start, end in ranges
+            ]})
+            requests_made += 1
+            log_info(f"[GSHEET] Deleted {len(self._deletes)} row(s) in {len(ranges)} range(s)")
+        if self._appends:
+            self.sheet.append_rows(self._appends, value_input_option="RAW")
+            requests_made += 1
+        if self.snapshot is not None:
+            self.snapshot.apply(updates, self._deletes, self._appends)
+        self._updates, self._deletes, self._appends = {}, set(), []
+        return requests_made
+
+def repair_incomplete_rows(sheet, rows_by_id: Dict[str, list], writer: Optional[SheetWriter] = None,
+                           snap: Optional[SheetSnapshot] = None) -> int:
+    snap = snap or SheetSnapshot.read(sheet)
+    own_writer = writer is None
+    writer = writer or SheetWriter(sheet, snap)
     repaired = 0
-    for r, row in enumerate(values[1:], start=2):
-        v_idx = hmap.get("vssId")
-        if v_idx is None or v_idx >= len(row):
+    for r, vss in snap.incomplete():
+        full = rows_by_id.get(vss)
+        if not full:
             continue
-        vss = (row[v_idx] or "").strip()
-        if not vss or not row_is_incomplete(row, hmap):
-            continue
-        car = new_dict.get(vss)
-        if not car:
-            continue
-        try:
-            update_row_A_H(sheet, r, car)
-            repaired += 1
-        except Exception as e:
-            log_error(f"[GSHEET] Error repairing row vssId={vss} (row={r})", e)
+        writer.update_row(r, full)
+        repaired += 1
+    if own_writer:
+        writer.flush()
     return repaired
 
-def dedupe_vssid_rows(sheet) -> int:
+def dedupe_vssid_rows(sheet, writer: Optional[SheetWriter] = None, snap: Optional[SheetSnapshot] = None) -> int:
     """Removes duplicates by vssId, keeping the first instance."""
-    values = sheet.get_all_values()
-    if not values:
-        return 0
-    header = {name.strip(): i for i, name in enumerate(values[0])}
-    col = header.get("vssId")
+    snap = snap or SheetSnapshot.read(sheet)
+    to_delete = snap.duplicates()
+    own_writer = writer is None
+    writer = writer or SheetWriter(sheet, snap)
+    for r in to_delete:
+        writer.delete_row(r)
+        log_info(f"[GSHEET] DEDUPE: removing duplicate (row={r})")
+    if own_writer:
+        writer.flush()
+    return len(to_delete)
+
+# =========================
+# Market statistics (kept current by LotStore, read by /stats)
+# =========================
+def row_number(val) -> int:
+    """Price/mileage cell as an int; rows seeded from the sheet hold formatted text."""
+    try:
+        return int(float(val))
+    except (TypeError, ValueError):
+        digits = "".join(ch for ch in str(val) if ch.isdigit())
+        return int(digits) if digits else 0
+
+def row_time(val) -> Optional[datetime]:
+    """The date_added cell as a datetime, None if it is not a timestamp."""
+    try:
+        return datetime.fromisoformat(str(val).strip()[:19])
+    except ValueError:
+        return None
+
+class LogHistogram:
+    """
+    Counts (and sums) of non-negative values in geometric buckets 2% wide: adding or
+    removing a value is O(1) and a quantile is its bucket's mean, within 2% of the exact
+    value however many values went in. Histograms of several groups merge bucket by bucket.
+    """
+    STEP = math.log(1.02)
+
+    __slots__ = ("counts", "sums", "n")
+
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.sums: Dict[int, float] = {}
+        self.n = 0
+
+    def add(self, value: float, k: int = 1):
+        i = int(math.log(value) / self.STEP) if value >= 1 else -1  # -1: values below 1
+        c = self.counts.get(i, 0) + k
+        if c > 0:
+            self.counts[i] = c
+            self.sums[i] = self.sums.get(i, 0.0) + k * value
+        else:
+            self.counts.pop(i, None)
+            self.sums.pop(i, None)
+        self.n += k
+
+    def merge(self, other: "LogHistogram"):
+        for i, c in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + c
+            self.sums[i] = self.sums.get(i, 0.0) + other.sums[i]
+        self.n += other.n
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.n <= 0:
+            return None
+        rank = q * (self.n - 1)
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen > rank:
+                return self.sums[i] / self.counts[i]
+        return None
+
+def _bump(counts: Dict[int, int], key: int, k: int):
+    c = counts.get(key, 0) + k
+    if c > 0:
+        counts[key] = c
+    else:
+        counts.pop(key, None)
+
+class MarketGroup:
+    """Aggregates of one model/fuel/gearbox/mileage band (or a merge of several)."""
+
+    __slots__ = ("price", "mileage", "listed", "new", "gone", "dom")
+
+    def __init__(self):
+        self.price = LogHistogram()     # active lots
+        self.mileage = LogHistogram()   # active lots
+        self.listed: Dict[int, int] = {}  # active lots by day listed
+        self.new: Dict[int, int] = {}     # lots listed per day, within the window
+        self.gone: Dict[int, int] = {}    # lots gone per day, within the window
+        self.dom: Dict[int, LogHistogram] = {}  # per day gone: hours those lots had been listed
+
+    def merge(self, other: "MarketGroup"):
+        self.price.merge(other.price)
+        self.mileage.merge(other.mileage)
+        for mine, theirs in ((self.listed, other.listed), (self.new, other.new), (self.gone, other.gone)):
+            for day, n in theirs.items():
+                mine[day] = mine.get(day, 0) + n
+        for day, hist in other.dom.items():
+            self.dom.setdefault(day, LogHistogram()).merge(hist)
+
+    def empty(self) -> bool:
+        return not (self.mileage.n or self.new or self.gone)
+
+class MarketStats:
+    """
+    Rolling market aggregates per (model, fuel, gearbox, mileage band), updated by LotStore
+    as lots are added, changed and removed, so /stats never rescans the lots: active count,
+    price/mileage quantiles and time on market of the active lots, and over the last `window`
+    days the lots listed, the lots gone and how long those had been listed. Each update costs
+    O(1) in the number of lots; a query merges the matching groups. Thread-safe.
+    """
+
+    def __init__(self, window_days: int = STATS_WINDOW_DAYS, bands: List[int] = STATS_MILEAGE_BANDS):
+        self.window = window_days
+        self.bands = bands
+        self._lock = threading.Lock()
+        self._groups: Dict[Tuple[str, str, str, int], MarketGroup] = {}
+
+    def _group(self, row: list) -> MarketGroup:
+        row = list(row) + [""] * (8 - len(row))
+        key = (str(row[1]), str(row[5]), str(row[4]), bisect.bisect_right(self.bands, row_number(row[3])))
+        g = self._groups.get(key)
+        if g is None:
+            g = self._groups[key] = MarketGroup()
+        return g
+
+    def _cutoff(self) -> int:
+        return date.today().toordinal() - self.window + 1
+
+    def _prune(self, g: MarketGroup):
+        cutoff = self._cutoff()
+        for days in (g.new, g.gone, g.dom):
+            for day in [d for d in days if d < cutoff]:
+                del days[day]
+
+    @staticmethod
+    def _active(g: MarketGroup, row: list, k: int):
+        price = row_number(row[2]) if len(row) > 2 else 0
+        if price:
+            g.price.add(price, k)
+        g.mileage.add(row_number(row[3]) if len(row) > 3 else 0, k)
+        listed = row_time(row[7]) if len(row) > 7 else None
+        if listed is not None:
+            _bump(g.listed, listed.toordinal(), k)
+
+    def _listed(self, g: MarketGroup, row: list, k: int):
+        listed = row_time(row[7]) if len(row) > 7 else None
+        if listed is not None and listed.toordinal() >= self._cutoff():
+            _bump(g.new, listed.toordinal(), k)
+
+    def _departed(self, g: MarketGroup, row: list, when: datetime):
+        day = when.toordinal()
+        if day < self._cutoff():
+            return
+        _bump(g.gone, day, 1)
+        listed = row_time(row[7]) if len(row) > 7 else None
+        if listed is not None:
+            g.dom.setdefault(day, LogHistogram()).add(max(0.0, (when - listed).total_seconds() / 3600))
+
+    def add(self, row: list):
+        """A lot entered the store."""
+        with self._lock:
+            g = self._group(row)
+            self._active(g, row, 1)
+            self._listed(g, row, 1)
+            self._prune(g)
+
+    def change(self, old_row: list, new_row: list):
+        with self._lock:
+            old, new = self._group(old_row), self._group(new_row)
+            self._active(old, old_row, -1)
+            self._active(new, new_row, 1)
+            if old is not new:
+                self._listed(old, old_row, -1)
+                self._listed(new, new_row, 1)
+
+    def remove(self, row: list, when: datetime):
+        """A lot left the store (no search returns it any more)."""
+        with self._lock:
+            g = self._group(row)
+            self._active(g, row, -1)
+            self._departed(g, row, when)
+            self._prune(g)
+
+    def departed(self, row: list, when: datetime):
+        """Replays a removal from before this process started (the lot is not active)."""
+        with self._lock:
+            g = self._group(row)
+            self._listed(g, row, 1)
+            self._departed(g, row, when)
+
+    def band_label(self, band: int) -> str:
+        lo = self.bands[band - 1] if band > 0 else 0
+        return f"{lo}+" if band >= len(self.bands) else f"{lo}-{self.bands[band]}"
+
+    def select(self, terms: Iterable[str] = (), min_km: int = 0,
+               max_km: Optional[int] = None) -> Dict[Tuple[str, str, str], MarketGroup]:
+        """
+        {(model, fuel, gearbox): aggregates} of the groups whose labels contain every term
+        (case-insensitive), merged over the mileage bands inside [min_km, max_km).
+        """
+        terms = [t.lower() for t in terms]
+        out: Dict[Tuple[str, str, str], MarketGroup] = {}
+        with self._lock:
+            cutoff = self._cutoff()
+            for (model, fuel, gearbox, band), g in self._groups.items():
+                lo = self.bands[band - 1] if band > 0 else 0
+                hi = self.bands[band] if band < len(self.bands) else None
+                if lo < min_km or (max_km is not None and (hi is None or hi > max_km)):
+                    continue
+                label = f"{model} {fuel} {gearbox}".lower()
+                if not all(t in label for t in terms):
+                    continue
+                merged = out.setdefault((model, fuel, gearbox), MarketGroup())
+                merged.merge(g)
+            for merged in out.values():
+                for days in (merged.new, merged.gone, merged.dom):
+                    for day in [d for d in days if d < cutoff]:
+                        del days[day]
+        return {k: g for k, g in out.items() if not g.empty()}
+
+def stats_report(stats: MarketStats, args: str = "") -> str:
+    """/stats text: totals for the filter, then its largest model/fuel/gearbox groups."""
+    terms: List[str] = []
+    min_km, max_km = 0, None
+    for token in args.split():
+        bound = token.lower().removesuffix("km")
+        if bound[:1] in "<>" and bound[1:].rstrip("k").isdigit():
+            km = int(bound[1:].rstrip("k")) * (1000 if bound.endswith("k") else 1)
+            if bound[0] == "<":
+                max_km = km
+            else:
+                min_km = km
+        else:
+            terms.append(token)
+    groups = stats.select(terms, min_km, max_km)
+    # mileage filters snap to the band edges
+    lo = min([b for b in (0, *stats.bands) if b >= min_km], default=min_km)
+    hi = None if max_km is None else max([b for b in stats.bands if b <= max_km], default=0)
+    title = " ".join(terms) or "all lots"
+    if min_km or max_km is not None:
+        title += f", mileage {format_price(lo)}-{'' if hi is None else format_price(hi)} km"
+    if not groups:
+        return f"📊 {title}: no lots"
+
+    total = MarketGroup()
+    for g in groups.values():
+        total.merge(g)
+    today = date.today().toordinal()
+    dom = LogHistogram()
+    for hist in total.dom.values():
+        dom.merge(hist)
+    age = LogHistogram()
+    for day, n in total.listed.items():
+        age.add(today - day, n)
+
+    def q(hist: LogHistogram, p: float, scale: float = 1) -> str:
+        v = hist.quantile(p)
+        return "-" if v is None else format_price(round(v / scale))
+
+    lines = [
+        f"📊 {title} (last {stats.window} d)",
+        f"active {total.mileage.n} · listed {sum(total.new.values())} · gone {sum(total.gone.values())}",
+        f"price     p25 {q(total.price, 0.25)} · p50 {q(total.price, 0.5)} · p75 {q(total.price, 0.75)} €",
+        f"mileage   p25 {q(total.mileage, 0.25)} · p50 {q(total.mileage, 0.5)} · p75 {q(total.mileage, 0.75)} km",
+        f"listed    p50 {q(age, 0.5)} · p90 {q(age, 0.9)} d ago (active lots)",
+        f"on market p50 {q(dom, 0.5, 24)} · p90 {q(dom, 0.9, 24)} d (gone lots)",
+        "",
+        f"{'model':<24} {'fuel':<10} {'gearbox':<10} {'n':>4} {'p50 €':>8} {'p50 km':>8}",
+    ]
+    for (model, fuel, gearbox), g in sorted(groups.items(), key=lambda kv: -kv[1].mileage.n)[:15]:
+        lines.append(f"{model[:24]:<24} {fuel[:10]:<10} {gearbox[:10]:<10} {g.mileage.n:>4} "
+                     f"{q(g.price, 0.5):>8} {q(g.mileage, 0.5):>8}")
+    if len(groups) > 15:
+        lines.append(f"... {len(groups) - 15} more groups")
+    return "\n".join(lines)
+
+# =========================
+# Local state store (source of truth; the sheet is a write-behind mirror)
+# =========================
+class LotStore:
+    """
+    SQLite table of known lots keyed by vssId, with first/last-seen timestamps, plus
+    `lot_profiles`: which search profile (and sheet tab) each lot currently belongs to.
+    Every change also lands in `sheet_outbox`, which sync_sheet_once drains into the sheet,
+    and in `stats` (MarketStats); lots leaving the store are kept in `lot_departures` for it.
+    Thread-safe: the sheet syncer runs in a worker thread.
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent; skips an fsync per commit
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS lots ("
+                " vss_id TEXT PRIMARY KEY,"
+                " row TEXT NOT NULL,"
+                " first_seen TEXT NOT NULL,"
+                " last_seen TEXT NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS lot_profiles ("
+                " vss_id TEXT NOT NULL,"
+                " profile TEXT NOT NULL,"
+                " tab TEXT NOT NULL DEFAULT '',"
+                " PRIMARY KEY (vss_id, profile))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sheet_outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " op TEXT NOT NULL,"
+                " vss_id TEXT NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sheet_checkpoint ("
+                " tab TEXT PRIMARY KEY,"
+                " data BLOB NOT NULL,"
+                " verified REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS notify_journal ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " chat_id INTEGER NOT NULL,"
+                " vss_id TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " text TEXT NOT NULL,"
+                " photo TEXT,"
+                " created REAL NOT NULL,"
+                " state INTEGER NOT NULL DEFAULT 0)"  # 0 pending, 1 sent, 2 given up
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS notify_journal_pending ON notify_journal (state, id)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS lot_departures ("
+                " vss_id TEXT NOT NULL,"
+                " row TEXT NOT NULL,"
+                " gone TEXT NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS lot_departures_gone ON lot_departures (gone)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                " name TEXT PRIMARY KEY,"
+                " owner TEXT NOT NULL,"
+                " expires REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS poll_stats ("
+                " hour INTEGER PRIMARY KEY,"
+                " changes REAL NOT NULL,"
+                " seconds REAL NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS photo_file_ids ("
+                " url TEXT PRIMARY KEY,"
+                " file_id TEXT NOT NULL,"
+                " updated TEXT NOT NULL)"
+            )
+            cols = {r[1] for r in self._db.execute("PRAGMA table_info(lots)")}
+            if "fp" not in cols:
+                self._db.execute("ALTER TABLE lots ADD COLUMN fp TEXT")
+            cols = {r[1] for r in self._db.execute("PRAGMA table_info(sheet_outbox)")}
+            if "tab" not in cols:
+                self._db.execute("ALTER TABLE sheet_outbox ADD COLUMN tab TEXT NOT NULL DEFAULT ''")
+            cols = {r[1] for r in self._db.execute("PRAGMA table_info(notify_journal)")}
+            if "worker" not in cols:
+                self._db.execute("ALTER TABLE notify_journal ADD COLUMN worker TEXT NOT NULL DEFAULT ''")
+        self.stats = MarketStats()
+        self._departures_pruned = 0.0
+        self.reload_stats()
+
+    def _prune_departures(self, before: str):
+        """Departures older than the stats window are never read again (call under the lock)."""
+        self._departures_pruned = time.time()
+        self._db.execute("DELETE FROM lot_departures WHERE gone < ?", (before,))
+
+    def reload_stats(self):
+        """
+        Rebuilds `stats` from the lots and the window's departures: once at start, and
+        periodically for a worker answering /stats while others also write the store.
+        """
+        stats = MarketStats()
+        since = (datetime.now() - timedelta(days=stats.window)).strftime("%Y-%m-%d")
+        with self._lock, self._db:
+            self._prune_departures(since)
+        # only the raw reads hold the lock; parsing and binning run while the sweep keeps writing
+        with self._lock:
+            lots = self._db.execute("SELECT row FROM lots").fetchall()
+            departures = self._db.execute("SELECT row, gone FROM lot_departures WHERE gone >= ?", (since,)).fetchall()
+        for (row,) in lots:
+            stats.add(json.loads(row))
+        for row, gone in departures:
+            when = row_time(gone)
+            if when is not None:
+                stats.departed(json.loads(row), when)
+        with self._lock:
+            self.stats = stats
+
+    @staticmethod
+    def _in(ids: List[str]) -> str:
+        return f"({','.join('?' * len(ids))})"
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM lots").fetchone()[0]
+
+    def known_ids(self) -> Set[str]:
+        with self._lock:
+            return {r[0] for r in self._db.execute("SELECT vss_id FROM lots")}
+
+    def fingerprints(self, ids: Optional[Iterable[str]] = None) -> Dict[str, Optional[str]]:
+        """{vssId: content hash}; None for lots seeded from the sheet and not fingerprinted yet."""
+        with self._lock:
+            if ids is None:
+                return dict(self._db.execute("SELECT vss_id, fp FROM lots"))
+            ids = list(ids)
+            if not ids:
+                return {}
+            return dict(self._db.execute(f"SELECT vss_id, fp FROM lots WHERE vss_id IN {self._in(ids)}", ids))
+
+    def members(self, profile: str, ids: Optional[Iterable[str]] = None) -> Set[str]:
+        """vssIds belonging to `profile` (optionally only among `ids`)."""
+        with self._lock:
+            if ids is None:
+                cur = self._db.execute("SELECT vss_id FROM lot_profiles WHERE profile = ?", (profile,))
+            else:
+                ids = list(ids)
+                if not ids:
+                    return set()
+                cur = self._db.execute(
+                    f"SELECT vss_id FROM lot_profiles WHERE profile = ? AND vss_id IN {self._in(ids)}",
+                    [profile] + ids,
+                )
+            return {r[0] for r in cur}
+
+    def profiles_of(self, ids: Iterable[str]) -> Dict[str, Set[str]]:
+        ids = list(ids)
+        out: Dict[str, Set[str]] = {v: set() for v in ids}
+        if not ids:
+            return out
+        with self._lock:
+            for v, profile in self._db.execute(
+                f"SELECT vss_id, profile FROM lot_profiles WHERE vss_id IN {self._in(ids)}", ids
+            ):
+                out[v].add(profile)
+        return out
+
+    def tabs(self) -> Set[str]:
+        with self._lock:
+            return {r[0] for r in self._db.execute("SELECT DISTINCT tab FROM lot_profiles")}
+
+    def rows(self, ids: Optional[Iterable[str]] = None) -> Dict[str, list]:
+        with self._lock:
+            if ids is None:
+                cur = self._db.execute("SELECT vss_id, row FROM lots")
+            else:
+                ids = list(ids)
+                if not ids:
+                    return {}
+                cur = self._db.execute(f"SELECT vss_id, row FROM lots WHERE vss_id IN {self._in(ids)}", ids)
+            return {v: json.loads(row) for v, row in cur}
+
+    def tab_rows(self, tab: str) -> Dict[str, list]:
+        """Rows of the lots that should be on sheet tab `tab`."""
+        with self._lock:
+            cur = self._db.execute(
+                "SELECT DISTINCT l.vss_id, l.row FROM lots l"
+                " JOIN lot_profiles p ON p.vss_id = l.vss_id WHERE p.tab = ?", (tab,)
+            )
+            return {v: json.loads(row) for v, row in cur}
+
+    def add(self, lots: Dict[str, Lot], ts: str):
+        """Inserts new lots (row as in the sheet); join() attaches them to a profile and its tab."""
+        if not lots:
+            return
+        rows = {v: build_full_row(lot) for v, lot in lots.items()}
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO lots (vss_id, row, first_seen, last_seen, fp) VALUES (?, ?, ?, ?, ?)",
+                [(v, json.dumps(rows[v], ensure_ascii=False), ts, ts, lot.fp) for v, lot in lots.items()],
+            )
+            for row in rows.values():
+                self.stats.add(row)
+
+    def join(self, profile: str, tab: str, ids: Iterable[str]) -> Dict[str, Set[str]]:
+        """
+        Adds lots to a profile and queues them for the profile's sheet tab. Returns the profiles
+        each lot belonged to just before, read in the same write transaction, `profile` itself
+        included when it already held the lot: of several workers joining a lot at once (even
+        for the same profile, around a lease handover), each sees the others' joins, so its
+        chats are alerted once.
+        """
+        pairs = [(v, profile, tab) for v in ids]
+        if not pairs:
+            return {}
+        ids = [v for v, _, _ in pairs]
+        owners: Dict[str, Set[str]] = {v: set() for v in ids}
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            for v, other in self._db.execute(
+                f"SELECT vss_id, profile FROM lot_profiles WHERE vss_id IN {self._in(ids)}", ids
+            ):
+                owners[v].add(other)
+            self._db.executemany("INSERT OR IGNORE INTO lot_profiles (vss_id, profile, tab) VALUES (?, ?, ?)", pairs)
+            self._db.executemany(
+                "INSERT INTO sheet_outbox (op, vss_id, tab) VALUES ('upsert', ?, ?)", [(v, tab) for v, _, _ in pairs]
+            )
+        return owners
+
+    def leave(self, profile: str, tab: str, ids: Iterable[str]) -> Dict[str, Set[str]]:
+        """
+        Removes lots from a profile and queues their removal from its tab; lots that belong
+        to no profile any more are deleted. Returns the profiles each lot still belongs to,
+        read in the same transaction (see join()).
+        """
+        ids = list(ids)
+        if not ids:
+            return {}
+        owners: Dict[str, Set[str]] = {v: set() for v in ids}
+        with self._lock, self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.executemany(
+                "DELETE FROM lot_profiles WHERE vss_id = ? AND profile = ?", [(v, profile) for v in ids]
+            )
+            self._db.executemany(
+                "INSERT INTO sheet_outbox (op, vss_id, tab) VALUES ('delete', ?, ?)", [(v, tab) for v in ids]
+            )
+            for v, other in self._db.execute(
+                f"SELECT vss_id, profile FROM lot_profiles WHERE vss_id IN {self._in(ids)}", ids
+            ):
+                owners[v].add(other)
+            orphans = [v for v, o in owners.items() if not o]
+            if orphans:
+                now = datetime.now()
+                gone = list(self._db.execute(
+                    f"SELECT vss_id, row FROM lots WHERE vss_id IN {self._in(orphans)}", orphans
+                ))
+                self._db.executemany(
+                    "INSERT INTO lot_departures (vss_id, row, gone) VALUES (?, ?, ?)",
+                    [(v, row, now.strftime("%Y-%m-%d %H:%M:%S")) for v, row in gone],
+                )
+                self._db.executemany("DELETE FROM lots WHERE vss_id = ?", [(v,) for v in orphans])
+                for _, row in gone:
+                    self.stats.remove(json.loads(row), now)
+                if time.time() - self._departures_pruned > 3600:
+                    self._prune_departures((now - timedelta(days=self.stats.window)).strftime("%Y-%m-%d"))
+        return owners
+
+    def update(self, changes: Dict[str, Tuple[list, str]], ts: str, sync: Iterable[str],
+               expected: Optional[Dict[str, Optional[str]]] = None) -> Set[str]:
+        """
+        Stores new rows/fingerprints {vssId: (row, fp)} of changed lots.
+        Only the ids in `sync` (whose visible fields really changed) are queued for their tabs.
+        With `expected` {vssId: fp the caller diffed against}, a lot is only updated if its stored
+        fingerprint is still that one, so a change seen by several workers is applied once.
+        Returns the updated ids.
+        """
+        if not changes:
+            return set()
+        done: Set[str] = set()
+        with self._lock, self._db:
+            ids = list(changes)
+            old_rows = dict(self._db.execute(f"SELECT vss_id, row FROM lots WHERE vss_id IN {self._in(ids)}", ids))
+            for v, (row, fp) in changes.items():
+                if expected is None:
+                    cur = self._db.execute("UPDATE lots SET row = ?, fp = ?, last_seen = ? WHERE vss_id = ?",
+                                           (json.dumps(row, ensure_ascii=False), fp, ts, v))
+                else:
+                    cur = self._db.execute("UPDATE lots SET row = ?, fp = ?, last_seen = ? WHERE vss_id = ? AND fp IS ?",
+                                           (json.dumps(row, ensure_ascii=False), fp, ts, v, expected.get(v)))
+                if cur.rowcount:
+                    done.add(v)
+                    if v in old_rows:
+                        self.stats.change(json.loads(old_rows[v]), row)
+            sync = [v for v in sync if v in done]
+            if sync:
+                self._db.execute(
+                    "INSERT INTO sheet_outbox (op, vss_id, tab)"
+                    f" SELECT DISTINCT 'upsert', vss_id, tab FROM lot_profiles WHERE vss_id IN {self._in(sync)}", sync
+                )
+        return done
+
+    def touch(self, ids: Iterable[str], ts: str):
+        with self._lock, self._db:
+            self._db.executemany("UPDATE lots SET last_seen = ? WHERE vss_id = ?", [(ts, v) for v in ids])
+
+    def seed(self, rows: Dict[str, list], ts: str, profile: str, tab: str):
+        """Bootstrap from existing sheet rows; nothing is queued since the sheet already has them."""
+        with self._lock, self._db:
+            for v, row in rows.items():
+                if self._db.execute(
+                    "INSERT OR IGNORE INTO lots (vss_id, row, first_seen, last_seen) VALUES (?, ?, ?, ?)",
+                    (v, json.dumps(row, ensure_ascii=False), row[7] or ts, ts),
+                ).rowcount:
+                    self.stats.add(row)
+            self._db.executemany(
+                "INSERT OR IGNORE INTO lot_profiles (vss_id, profile, tab) VALUES (?, ?, ?)",
+                [(v, profile, tab) for v in rows],
+            )
+
+    def adopt_orphans(self, profile: str, tab: str) -> int:
+        """Assigns lots without any profile (state from before profiles existed) to `profile`."""
+        with self._lock, self._db:
+            return self._db.execute(
+                "INSERT INTO lot_profiles (vss_id, profile, tab)"
+                " SELECT vss_id, ?, ? FROM lots WHERE vss_id NOT IN (SELECT vss_id FROM lot_profiles)",
+                (profile, tab),
+            ).rowcount
+
+    def pending(self, limit: int) -> List[Tuple[int, str, str, str]]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, op, vss_id, tab FROM sheet_outbox ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+
+    def outbox_size(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM sheet_outbox").fetchone()[0]
+
+    def ack(self, max_id: int):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM sheet_outbox WHERE id <= ?", (max_id,))
+
+    def sheet_checkpoint(self, tab: str) -> Optional[Tuple[List[list], float]]:
+        """(sheet values, when they were last read from the sheet) saved by the last sync of `tab`."""
+        with self._lock:
+            row = self._db.execute("SELECT data, verified FROM sheet_checkpoint WHERE tab = ?", (tab,)).fetchone()
+        return (json.loads(zlib.decompress(row[0])), row[1]) if row else None
+
+    def save_sheet_checkpoint(self, tab: str, values: List[list], verified: float):
+        data = zlib.compress(json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sheet_checkpoint (tab, data, verified) VALUES (?, ?, ?)", (tab, data, verified)
+            )
+
+    def clear_sheet_checkpoints(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM sheet_checkpoint")
+
+    def journal_add(self, chat_id: int, vss_id: str, kind: str, text: str, photo: Optional[str] = None,
+                    worker: str = "") -> int:
+        """Records an alert before it is queued for Telegram; journal_done() closes it."""
+        with self._lock, self._db:
+            return self._db.execute(
+                "INSERT INTO notify_journal (chat_id, vss_id, kind, text, photo, created, worker)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, vss_id, kind, text, photo, time.time(), worker),
+            ).lastrowid
+
+    def journal_done(self, entry_id: int, delivered: bool):
+        with self._lock, self._db:
+            self._db.execute("UPDATE notify_journal SET state = ? WHERE id = ?", (1 if delivered else 2, entry_id))
+
+    def journal_pending(self, worker: str = "") -> List[Tuple[int, int, str, str, str, Optional[str], float]]:
+        """A worker's undelivered alerts: (id, chat_id, vss_id, kind, text, photo, created), oldest first."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, chat_id, vss_id, kind, text, photo, created FROM notify_journal"
+                " WHERE state = 0 AND worker = ? ORDER BY id", (worker,)
+            ).fetchall()
+
+    def journal_claim(self, entry_id: int) -> bool:
+        """Closes a pending entry for a resend; False if another process got to it first."""
+        with self._lock, self._db:
+            return self._db.execute(
+                "UPDATE notify_journal SET state = 2 WHERE id = ? AND state = 0", (entry_id,)
+            ).rowcount == 1
+
+    def journal_prune(self, before: float) -> int:
+        with self._lock, self._db:
+            return self._db.execute(
+                "DELETE FROM notify_journal WHERE state != 0 AND created < ?", (before,)
+            ).rowcount
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Takes or renews lease `name` for `ttl` seconds unless another owner holds it unexpired."""
+        now = time.time()
+        with self._lock, self._db:
+            return self._db.execute(
+                "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires"
+                " WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                (name, owner, now + ttl, now),
+            ).rowcount == 1
+
+    def release_leases(self, owner: str, names: Optional[Iterable[str]] = None):
+        with self._lock, self._db:
+            if names is None:
+                self._db.execute("DELETE FROM leases WHERE owner = ?", (owner,))
+            else:
+                self._db.executemany("DELETE FROM leases WHERE name = ? AND owner = ?", [(n, owner) for n in names])
+
+    def drop_expired_lease(self, name: str) -> bool:
+        with self._lock, self._db:
+            return self._db.execute(
+                "DELETE FROM leases WHERE name = ? AND expires < ?", (name, time.time())
+            ).rowcount == 1
+
+    def leases(self) -> Dict[str, Tuple[str, float]]:
+        """{name: (owner, expires)}"""
+        with self._lock:
+            return {n: (o, e) for n, o, e in self._db.execute("SELECT name, owner, expires FROM leases")}
+
+    def poll_stats(self) -> Dict[int, Tuple[float, float, float]]:
+        """{hour of day: (changes, seconds observed, updated epoch)} for ChangeRateModel."""
+        with self._lock:
+            return {h: (c, sec, upd) for h, c, sec, upd in self._db.execute(
+                "SELECT hour, changes, seconds, updated FROM poll_stats"
+            )}
+
+    def set_poll_stat(self, hour: int, changes: float, seconds: float, updated: float):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO poll_stats (hour, changes, seconds, updated) VALUES (?, ?, ?, ?)",
+                (hour, changes, seconds, updated),
+            )
+
+    def photo_file_id(self, url: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT file_id FROM photo_file_ids WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def set_photo_file_id(self, url: str, file_id: Optional[str]):
+        with self._lock, self._db:
+            if file_id:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO photo_file_ids (url, file_id, updated) VALUES (?, ?, ?)",
+                    (url, file_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+                )
+            else:
+                self._db.execute("DELETE FROM photo_file_ids WHERE url = ?", (url,))
+
+def bootstrap_store_from_sheet(store: LotStore, book: SheetBook, profile: "SearchProfile") -> int:
+    """Seeds a profile without state from its sheet tab so existing rows are not re-alerted."""
+    rows = sheet_rows_by_vssid(book.tab(profile.sheet_tab))
+    store.seed(rows, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), profile.name, profile.sheet_tab)
+    return len(rows)
+
+def snapshot_is_current(sheet, snap: SheetSnapshot) -> bool:
+    """
+    Cheap check before writing by row number: the sheet's vssId column (one column read)
+    still lists the same lots in the same rows as the snapshot. False after someone sorted
+    the sheet or inserted/deleted rows by hand.
+    """
+    col = snap.vssid_col()
     if col is None:
-        log_error("In the Google Sheet header there is no column 'vssId'")
+        return False
+    with metrics.timer("sheet_verify"):
+        live = [v.strip() for v in sheet.col_values(col + 1)]
+    mine = ["vssId"] + [(row[col] if col < len(row) else "").strip() for row in snap.rows]
+    while live and not live[-1]:
+        live.pop()
+    while mine and not mine[-1]:
+        mine.pop()
+    return live == mine
+
+def tab_snapshot(book: SheetBook, store: LotStore, tab: str, refresh: bool = False) -> Tuple[SheetSnapshot, bool]:
+    """
+    Contents of a tab as the syncer last left them: kept in memory between passes and
+    checkpointed in the store, so a restart does not rescan the sheet. It is re-read from
+    the sheet once the copy is older than SHEET_VERIFY_INTERVAL, or with `refresh`.
+    Returns (snapshot, freshly read); a copy that was not freshly read must pass
+    snapshot_is_current() before row numbers taken from it are written to.
+    """
+    cached = None if refresh else book.snapshots.get(tab)
+    if cached is None and not refresh:
+        checkpoint = store.sheet_checkpoint(tab)
+        if checkpoint is not None:
+            cached = book.snapshots[tab] = (SheetSnapshot(checkpoint[0]), checkpoint[1])
+            log_info(f"[GSHEET] {tab or 'sheet1'}: resumed from checkpoint "
+                     f"({len(cached[0].rows)} rows, read {time.time() - checkpoint[1]:.0f}s ago)")
+    if cached is not None and time.time() - cached[1] < SHEET_VERIFY_INTERVAL:
+        return cached[0], False
+    snap = SheetSnapshot.read(book.tab(tab))
+    book.snapshots[tab] = (snap, time.time())
+    return snap, True
+
+def sync_tab(sheet, store: LotStore, tab: str, vss_ids: List[str], snap: SheetSnapshot) -> Tuple[int, int]:
+    """
+    One tab of a sync pass. A queued lot is upserted if it still belongs to a profile
+    writing to this tab and deleted otherwise. Returns (appended rows, requests made).
+    """
+    # every mutation is queued against the snapshot's row numbers and sent in one flush
+    writer = SheetWriter(sheet, snap)
+    d = dedupe_vssid_rows(sheet, writer, snap)
+    if d:
+        log_info(f"[GSHEET] DEDUPE: removed duplicates: {d}")
+
+    rows = store.tab_rows(tab)
+    sheet_idx = sheet_index_by_vssid(sheet, snap)
+    added_cnt = 0
+    for v in vss_ids:
+        row = rows.get(v)
+        if row is None:
+            if v in sheet_idx:
+                writer.delete_row(sheet_idx[v])
+                log_info(f"[GSHEET] Deleting row vssId={v} (row={sheet_idx[v]})")
+        elif v in sheet_idx:
+            writer.update_row(sheet_idx[v], row)
+        else:
+            writer.append_row(row)
+            added_cnt += 1
+
+    repaired = repair_incomplete_rows(sheet, rows, writer, snap)
+    if repaired:
+        log_info(f"[GSHEET] Repaired rows: {repaired}")
+    return added_cnt, writer.flush()
+
+def sync_sheet_once(book: SheetBook, store: LotStore, force: bool = False) -> int:
+    """
+    Pushes one batch of queued changes to the sheet tabs, together with dedupe and row repair.
+    The batch is acknowledged only after the sheet accepted it, so an outage just delays it.
+    Returns the number of processed outbox entries.
+    """
+    ops = store.pending(SHEET_SYNC_BATCH)
+    if not ops and not force:
         return 0
+    t0 = time.perf_counter()
+
+    by_tab: Dict[str, Dict[str, None]] = {}  # tab -> ordered set of vssIds
+    for _, _, v, tab in ops:
+        by_tab.setdefault(tab, {})[v] = None
+    if force:
+        for tab in store.tabs():
+            by_tab.setdefault(tab, {})
+
+    for tab, ids in by_tab.items():
+        snap, fresh = tab_snapshot(book, store, tab)
+        if not fresh and not snapshot_is_current(book.tab(tab), snap):
+            log_info(f"[GSHEET] {tab or 'sheet1'}: rows were moved outside the bot, re-reading")
+            metrics.inc("sheet_snapshot_stale")
+            snap, fresh = tab_snapshot(book, store, tab, refresh=True)
+        added_cnt, calls = sync_tab(book.tab(tab), store, tab, list(ids), snap)
+        if calls or fresh:
+            store.save_sheet_checkpoint(tab, snap.values(), book.snapshots[tab][1])
+        name = tab or "sheet1"
+        if added_cnt:
+            log_info(f"[GSHEET] {name}: added rows: {added_cnt}")
+        if calls:
+            log_info(f"[GSHEET] {name}: {len(ids)} change(s) in {calls} request(s)")
+
+    if ops:
+        store.ack(ops[-1][0])
+    metrics.observe("sheet_sync", time.perf_counter() - t0)
+    metrics.inc("sheet_outbox_acked", len(ops))
+    return len(ops)
+
+async def sheet_sync_loop(store: LotStore, coordinator: Optional["LeaseCoordinator"] = None):
+    """
+    Write-behind mirror: keeps retrying (and reconnecting) until the outbox reaches the sheet.
+    With workers, only the one holding the `sheet` lease writes.
+    """
+    book: Optional[SheetBook] = None
+    force = True  # first pass dedupes/repairs even with an empty outbox
+    while True:
+        if coordinator is not None and not coordinator.holds("sheet"):
+            book, force = None, True  # another worker may have written meanwhile
+        elif book is None:
+            try:
+                book = await run_blocking(_sheets_pool, gs_open_book)
+                log_info("[GSHEET] Connection successful")
+            except Exception as e:
+                log_error("[GSHEET] Connection error", e)
+        if book is not None:
+            try:
+                while await run_blocking(_sheets_pool, sync_sheet_once, book, store, force) >= SHEET_SYNC_BATCH:
+                    force = False
+                force = False
+            except Exception as e:
+                log_error("[GSHEET] Sync failed, will retry", e)
+                # a half-sent flush leaves the sheet unlike any copy of it: read it afresh
+                store.clear_sheet_checkpoints()
+                book = None
+        await asyncio.sleep(SHEET_SYNC_INTERVAL)
 
-    seen: Dict[str, int] = {}
-    to_delete: List[int] = []
-    for r, row in enumerate(values[1:], start=2):
-        v = (row[col] if col < len(row) else "").strip()
-        if not v:
-            continue
-        if v in seen:
-            to_delete.append(r)
-        else:
-            seen[v] = r
+# =========================
+# Snapshot archive (what each cycle's searches returned; feeds --replay)
+# =========================
+class SnapshotArchive:
+    """
+    One snapshot per profile and cycle, keyed by the cycle timestamp. A snapshot stores only
+    the lots added/changed/removed since the profile's previous one, as zlib-compressed JSON;
+    every ARCHIVE_KEYFRAME_EVERY-th snapshot is complete, so history can be pruned at a keyframe
+    and reading it back never starts further away than that. Used from one thread at a time;
+    several processes (workers) may write the same archive.
+    """
 
-    for r in sorted(to_delete, reverse=True):
-        try:
-            sheet.delete_rows(r)
-            log_info(f"[GSHEET] DEDUPE: removed duplicate (row={r})")
-        except Exception as e:
-            log_error(f"[GSHEET] DEDUPE: failed to delete row {r}", e)
-    return len(to_delete)
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " ts TEXT NOT NULL,"
+                " profile TEXT NOT NULL,"
+                " full INTEGER NOT NULL,"
+                " n_lots INTEGER NOT NULL,"
+                " payload BLOB NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS snapshots_profile ON snapshots (profile, id)")
+        self._state: Dict[str, Dict[str, Lot]] = {}  # profile -> lots of its latest snapshot
+        self._since_keyframe: Dict[str, int] = {}
+        self._last_id: Dict[str, int] = {}  # profile -> id of the snapshot _state reflects
+        self._pruned = 0.0
+
+    @staticmethod
+    def encode(upsert: Iterable[Lot], remove: Iterable[str]) -> bytes:
+        doc = {"upsert": [list(lot) for lot in upsert], "remove": list(remove)}
+        return zlib.compress(json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def decode(payload: bytes) -> Tuple[List[Lot], List[str]]:
+        doc = json.loads(zlib.decompress(payload))
+        lots = [Lot(*row[:6], tuple(row[6]), row[7]) for row in doc["upsert"]]
+        return lots, doc["remove"]
+
+    @staticmethod
+    def apply(state: Dict[str, Lot], full: bool, payload: bytes):
+        lots, removed = SnapshotArchive.decode(payload)
+        if full:
+            state.clear()
+        for v in removed:
+            state.pop(v, None)
+        for lot in lots:
+            state[lot.vss_id] = lot
+
+    def _latest(self, profile: str) -> Optional[Dict[str, Lot]]:
+        """Lots of the profile's latest snapshot (rebuilt from the DB after a restart)."""
+        if profile in self._state:
+            return self._state[profile]
+        key = self._db.execute(
+            "SELECT MAX(id) FROM snapshots WHERE profile = ? AND full = 1", (profile,)
+        ).fetchone()[0]
+        if key is None:
+            return None
+        state: Dict[str, Lot] = {}
+        rows = self._db.execute(
+            "SELECT full, payload FROM snapshots WHERE profile = ? AND id >= ? ORDER BY id", (profile, key)
+        ).fetchall()
+        for full, payload in rows:
+            self.apply(state, full, payload)
+        self._state[profile] = state
+        self._since_keyframe[profile] = len(rows) - 1
+        return state
+
+    def record(self, ts: str, profile: str, lots: Dict[str, Lot]) -> int:
+        """Stores the cycle's result set of one profile; returns the compressed size in bytes."""
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            head = self._db.execute("SELECT MAX(id) FROM snapshots WHERE profile = ?", (profile,)).fetchone()[0]
+            if head != self._last_id.get(profile):
+                # another worker archived this profile since: diff against its snapshots, not ours
+                self._state.pop(profile, None)
+            prev = self._latest(profile)
+            full = prev is None or self._since_keyframe.get(profile, 0) + 1 >= ARCHIVE_KEYFRAME_EVERY
+            if full:
+                payload = self.encode(lots.values(), [])
+            else:
+                payload = self.encode(
+                    [lot for v, lot in lots.items() if prev.get(v) != lot], [v for v in prev if v not in lots]
+                )
+            cur = self._db.execute(
+                "INSERT INTO snapshots (ts, profile, full, n_lots, payload) VALUES (?, ?, ?, ?, ?)",
+                (ts, profile, int(full), len(lots), payload),
+            )
+        self._last_id[profile] = cur.lastrowid
+        self._state[profile] = dict(lots)
+        self._since_keyframe[profile] = 0 if full else self._since_keyframe.get(profile, 0) + 1
+        if time.time() - self._pruned > 3600:
+            self._pruned = time.time()
+            self.prune((datetime.now() - timedelta(days=ARCHIVE_RETENTION_DAYS)).strftime("%Y-%m-%d %H:%M:%S"))
+        return len(payload)
+
+    def prune(self, before_ts: str) -> int:
+        """Drops snapshots older than before_ts, keeping each profile's chain from its last keyframe before it."""
+        deleted = 0
+        with self._db:
+            for profile, key in self._db.execute(
+                "SELECT profile, MAX(id) FROM snapshots WHERE full = 1 AND ts < ? GROUP BY profile", (before_ts,)
+            ).fetchall():
+                deleted += self._db.execute(
+                    "DELETE FROM snapshots WHERE profile = ? AND id < ?", (profile, key)
+                ).rowcount
+        if deleted:
+            log_info(f"[ARCHIVE] Pruned {deleted} snapshot(s) older than {before_ts}")
+        return deleted
+
+    def cycles(self, since: str = "") -> "Iterable[Tuple[str, Dict[str, Dict[str, Lot]]]]":
+        """
+        (cycle ts, {profile: lots}) in order, from the first cycle at or after `since`.
+        Decoding starts at the keyframes before it, so every yielded state is complete.
+        """
+        start = self._db.execute(
+            "SELECT MIN(k) FROM (SELECT MAX(id) AS k FROM snapshots WHERE full = 1 AND ts <= ? GROUP BY profile)",
+            (since,),
+        ).fetchone()[0] or 0
+        states: Dict[str, Dict[str, Lot]] = {}
+        cycle_ts: Optional[str] = None
+        cycle: Dict[str, Dict[str, Lot]] = {}
+        for ts, profile, full, payload in self._db.execute(
+            "SELECT ts, profile, full, payload FROM snapshots WHERE id >= ? ORDER BY id", (start,)
+        ):
+            if ts != cycle_ts:
+                if cycle and cycle_ts >= since:
+                    yield cycle_ts, cycle
+                cycle_ts, cycle = ts, {}
+            if not full and profile not in states:
+                continue  # delta without its keyframe (pruned or before the start)
+            state = states.setdefault(profile, {})
+            self.apply(state, full, payload)
+            cycle[profile] = dict(state)
+        if cycle and cycle_ts is not None and cycle_ts >= since:
+            yield cycle_ts, cycle
+
+    def size(self) -> Tuple[int, int]:
+        """(snapshots, compressed bytes)."""
+        n, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM snapshots").fetchone()
+        return n, total
+
+archive: Optional[SnapshotArchive] = None
 
 # =========================
 # Telegram helpers
@@ -448,6 +2649,10 @@ async def tg_send_with_retry(coro_factory, attempts=3, base_delay=1.0) -> bool:
         try:
             await coro_factory()
             return True
+        except TelegramRetryAfter as e:
+            log_error(f"[TELEGRAM] Flood control, retry after {e.retry_after}s, try {i+1}/{attempts}")
+            await asyncio.sleep(e.retry_after)
+            continue
         except TelegramNetworkError as e:
             log_error(f"[TELEGRAM] Network error, try {i+1}/{attempts}", e)
         except Exception as e:
@@ -456,26 +2661,155 @@ async def tg_send_with_retry(coro_factory, attempts=3, base_delay=1.0) -> bool:
         await asyncio.sleep(base_delay * (2 ** i))
     return False
 
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class TelegramDispatcher:
+    """
+    Fan-out queue for outgoing messages. Each chat has its own FIFO queue and worker,
+    so chats are served concurrently while the order within a chat is kept.
+    Sends are paced by a per-chat bucket (private or group limit) and one global bucket;
+    flood-control RetryAfter is honored by tg_send_with_retry inside the chat's worker.
+    """
+
+    def __init__(self, global_rate: float = TG_GLOBAL_RATE):
+        self._global = TokenBucket(global_rate, capacity=global_rate)
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+
+    @staticmethod
+    def chat_bucket(chat_id: int) -> TokenBucket:
+        if chat_id < 0:  # groups and channels
+            return TokenBucket(TG_GROUP_RATE_PER_MIN / 60.0, capacity=3)
+        return TokenBucket(TG_CHAT_RATE)
+
+    def submit(self, chat_id: int, send: Callable[[int], Awaitable], done_msg: str = "") -> asyncio.Future:
+        """
+        Queues send(chat_id); done_msg is logged once it was delivered.
+        The returned future resolves to True/False when the send is finished.
+        """
+        q = self._queues.get(chat_id)
+        if q is None:
+            q = self._queues[chat_id] = asyncio.Queue()
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id, q))
+        done = asyncio.get_running_loop().create_future()
+        q.put_nowait((send, done_msg, done))
+        return done
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self._queues.values())
+
+    async def join(self):
+        await asyncio.gather(*(q.join() for q in self._queues.values()))
+
+    async def _worker(self, chat_id: int, q: asyncio.Queue):
+        bucket = self.chat_bucket(chat_id)
+        while True:
+            send, done_msg, done = await q.get()
+            ok = False
+            try:
+                await bucket.acquire()
+                await self._global.acquire()
+                with metrics.timer("tg_send"):
+                    ok = await tg_send_with_retry(lambda: send(chat_id))
+                metrics.inc("tg_sent" if ok else "tg_failed")
+                if ok and done_msg:
+                    log_info(f"{done_msg} → chat {chat_id}")
+            except Exception as e:
+                log_error(f"[TG] Dispatcher error (chat {chat_id})", e)
+            finally:
+                if not done.done():
+                    done.set_result(ok)
+                q.task_done()
+
+class PhotoRef:
+    """
+    A car photo shared by every chat: sent by URL once, then by the Telegram file_id
+    returned for that first send (persisted per URL, so restarts skip the upload too).
+    """
+
+    def __init__(self, url: str, file_id: Optional[str] = None):
+        self.url = url
+        self.file_id = file_id
+        self.ready = asyncio.Event()
+        if file_id:
+            self.ready.set()
+
+async def send_photo_ref(chat_id: int, ref: PhotoRef, caption: str, store: "LotStore"):
+    photo = ref.file_id or ref.url
+    try:
+        msg = await bot.send_photo(chat_id, photo=photo, caption=caption)
+    except TelegramBadRequest:
+        if photo == ref.url:
+            raise
+        log_error(f"[TG] Cached file_id rejected, resending by URL: {ref.url}")
+        ref.file_id = None
+        store.set_photo_file_id(ref.url, None)
+        msg = await bot.send_photo(chat_id, photo=ref.url, caption=caption)
+    if not ref.file_id and getattr(msg, "photo", None):
+        ref.file_id = msg.photo[-1].file_id
+        store.set_photo_file_id(ref.url, ref.file_id)
+    return msg
+
 # =========================
 # Telegram bot
 # =========================
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
+dispatcher = TelegramDispatcher()
+metrics.gauge("tg_queue", lambda: dispatcher.pending())
+state_store: Optional["LotStore"] = None  # set by main(); /stats reads its aggregates
 
 @dp.message(Command("status"))
 async def status_handler(message: types.Message):
     try:
-        raw = tail_file(APP_LOG, 80000)  # take more to ensure we capture the cycle
+        raw = await asyncio.to_thread(tail_file, APP_LOG, 80000)  # take more to ensure we capture the cycle
         if not raw:
             await message.answer("Log file is missing.")
             return
-        block = extract_last_cycle_block(raw)
+        block = extract_last_cycle_block(raw) + "\n\n" + loop_lag.summary()
         safe = html_escape_strict(block)
         await message.answer(f"<pre>{safe}</pre>", parse_mode=ParseMode.HTML)
     except Exception as e:
         log_error("Error in /status", e)
         await message.answer("Failed to read log.")
 
+@dp.message(Command("metrics"))
+async def metrics_handler(message: types.Message):
+    try:
+        safe = html_escape_strict(metrics.summary())
+        await message.answer(f"<pre>{safe}</pre>", parse_mode=ParseMode.HTML)
+    except Exception as e:
+        log_error("Error in /metrics", e)
+        await message.answer("Failed to collect metrics.")
+
+@dp.message(Command("stats"))
+async def stats_handler(message: types.Message, command: CommandObject):
+    """/stats [model/fuel/gearbox words] [<40000km] [>20k]: answered from the in-memory aggregates."""
+    try:
+        report = stats_report(state_store.stats, command.args or "") if state_store is not None else "No data yet."
+        safe = html_escape_strict(report)
+        await message.answer(f"<pre>{safe}</pre>", parse_mode=ParseMode.HTML)
+    except Exception as e:
+        log_error("Error in /stats", e)
+        await message.answer("Failed to compute stats.")
+
 @dp.message(Command("logs"))
 async def logs_handler(message: types.Message):
     try:
@@ -508,155 +2842,775 @@ async def restart_handler(message: types.Message):
         await message.answer("♻️ Restarting...")
     except Exception as e:
         log_error("Error before restart", e)
-    asyncio.get_running_loop().call_later(
-        0.5, lambda: os.execv(sys.executable, [sys.executable] + sys.argv)
-    )
+    def restart():
+        _log_listener.stop()  # execv skips atexit: flush queued records first
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    asyncio.get_running_loop().call_later(0.5, restart)
 
 # =========================
-# Main monitoring
+# Poll scheduling
 # =========================
-async def monitor_loop(data: dict):
-    # Google Sheet connection
-    try:
-        sheet = gs_open_sheet()
-        log_info("[GSHEET] Connection successful")
-    except Exception as e:
-        log_error("[GSHEET] Connection error", e)
-        sheet = None
+class ChangeRateModel:
+    """
+    Listing changes per hour, learned separately for every hour of the day (local time):
+    decayed sums of observed changes and observed seconds, persisted in the store.
+    """
+    MIN_OBSERVED = 600  # seconds of observation before an hour's rate is used
+
+    def __init__(self, store: LotStore):
+        self.store = store
+        self._stats = store.poll_stats()
+        self._last = time.time()
+
+    def observe(self, changes: int):
+        """Changes found since the previous observation (by either polling tier)."""
+        now = time.time()
+        dt, self._last = min(now - self._last, 3600.0), now
+        hour = datetime.fromtimestamp(now).hour
+        c, sec, updated = self._stats.get(hour, (0.0, 0.0, now))
+        decay = 0.5 ** ((now - updated) / (RATE_HALF_LIFE_DAYS * 86400))
+        self._stats[hour] = (c * decay + changes, sec * decay + dt, now)
+        self.store.set_poll_stat(hour, *self._stats[hour])
+
+    def rate(self, hour: Optional[int] = None) -> Optional[float]:
+        """Expected changes per hour, or None while the hour has too little history."""
+        c, sec, _ = self._stats.get(datetime.now().hour if hour is None else hour, (0.0, 0.0, 0.0))
+        return c / sec * 3600 if sec >= self.MIN_OBSERVED else None
+
+class AdaptiveSchedule:
+    """
+    Delay before the next poll of one tier, between `fastest` and `slowest` seconds.
+    A poll that found changes resets it to `fastest`; each quiet poll stretches it by half,
+    but not beyond a quarter of the expected gap between changes at this hour, so busy
+    hours stay fast. Failed polls back off exponentially. Every delay gets POLL_JITTER.
+    """
 
-    # One-time deduplication on startup
-    if sheet:
-        try:
-            d = dedupe_vssid_rows(sheet)
-            if d:
-                log_info(f"[GSHEET] DEDUPE: removed duplicates: {d}")
-        except Exception as e:
-            log_error("[GSHEET] DEDUPE: startup error", e)
+    def __init__(self, name: str, fastest: float, slowest: float, rates: ChangeRateModel):
+        self.name = name
+        self.fastest = fastest
+        self.slowest = max(fastest, slowest)
+        self.rates = rates
+        self.quiet = 0
+        self.errors = 0
+
+    def next_delay(self, changes: Optional[int]) -> float:
+        """`changes` found by the last poll; None if it failed."""
+        if changes is None:
+            self.errors += 1
+            delay = min(self.slowest, self.fastest * 2 ** self.errors)
+        else:
+            self.errors = 0
+            self.quiet = 0 if changes else self.quiet + 1
+            delay = min(self.slowest, self.fastest * 1.5 ** self.quiet)
+            rate = self.rates.rate()
+            if rate:
+                delay = min(delay, max(self.fastest, 3600 / rate / 4))
+        return delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
 
-    while True:
-        cycle_ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        log_info(f"[{cycle_ts}] New monitoring cycle")
+# =========================
+# Worker leases (several processes sharing STATE_DB)
+# =========================
+class LeaseLostError(RuntimeError):
+    """This worker's lease on a profile ran out or was given up while it was being swept."""
 
-        # 1) Get fresh lots
-        hits = await asyncio.to_thread(get_all_bmw_lots, data)
-        new_dict = extract_id_dict_from_hits(hits)
-        new_ids = set(new_dict.keys())
-        log_info(f"[+] Received cars (unique): {len(new_ids)}")
+class LeaseCoordinator:
+    """
+    Splits the profiles between the workers sharing STATE_DB. Every worker renews a
+    `worker:<id>` heartbeat and holds its fair share of the `profile:<name>` leases (the unit of
+    work: removal detection needs a profile's whole result set); `sheet` (the write-behind mirror)
+    and `bot` (Telegram allows one getUpdates consumer) go to whoever takes them first.
+    A worker that stops renewing loses its leases after `ttl`; the others take over its profiles
+    and resend the alerts it had journaled but not delivered.
+    """
 
-        if sheet:
-            # Periodic deduplication
-            try:
-                d = dedupe_vssid_rows(sheet)
-                if d:
-                    log_info(f"[GSHEET] DEDUPE: removed duplicates: {d}")
-            except Exception as e:
-                log_error("[GSHEET] DEDUPE: cycle error", e)
+    def __init__(self, store: LotStore, worker: str, profiles: List[SearchProfile], ttl: float = LEASE_TTL):
+        self.store = store
+        self.worker = worker
+        self.profiles = profiles
+        self.ttl = ttl
+        self.held: Dict[str, float] = {}  # lease -> when it runs out unless renewed (time.time())
+        metrics.gauge("leases_held", lambda: len(self.held))
+
+    def holds(self, name: str) -> bool:
+        """True while the lease is held and not past its expiry, even if a renewal is overdue."""
+        return self.held.get(name, 0.0) > time.time()
+
+    def owned(self) -> List[SearchProfile]:
+        return [p for p in self.profiles if self.holds(f"profile:{p.name}")]
+
+    def _claim(self, name: str) -> bool:
+        t0 = time.time()
+        if self.store.acquire_lease(name, self.worker, self.ttl):
+            if name not in self.held:
+                log_info(f"[LEASE] {self.worker}: acquired {name}")
+            self.held[name] = t0 + self.ttl
+            return True
+        if name in self.held:
+            log_info(f"[LEASE] {self.worker}: lost {name}")
+            del self.held[name]
+        return False
 
-            # 2) Table state
+    def rebalance(self) -> List[str]:
+        """One heartbeat: renews what is held, takes or gives back profiles. Returns the workers found dead."""
+        self._claim(f"worker:{self.worker}")
+        for name in sorted(self.held):
+            self._claim(name)
+        now = time.time()
+        leases = self.store.leases()
+        workers = {n[len("worker:"):]: e for n, (_, e) in leases.items() if n.startswith("worker:")}
+        live = sum(1 for e in workers.values() if e >= now)
+        share = -(-len(self.profiles) // max(live, 1))
+
+        def free(name: str) -> bool:
+            lease = leases.get(name)
+            return lease is None or lease[1] < now or lease[0] == self.worker
+
+        mine = sorted(n for n in self.held if n.startswith("profile:"))
+        for p in self.profiles:
+            name = f"profile:{p.name}"
+            if len(mine) >= share:
+                break
+            if name not in self.held and free(name) and self._claim(name):
+                mine.append(name)
+        extra = mine[share:]
+        if extra:
+            # a newly started worker raised the live count: leave them for it
+            self.store.release_leases(self.worker, extra)
+            for name in extra:
+                del self.held[name]
+            log_info(f"[LEASE] {self.worker}: released {', '.join(extra)}")
+        for name in ("sheet", "bot"):
+            if name not in self.held and free(name):
+                self._claim(name)
+        return [w for w, e in workers.items() if e < now]
+
+    async def run(self):
+        stats_loaded = time.monotonic()
+        while True:
             try:
-                sheet_idx = sheet_index_by_vssid(sheet)  # {vssId: row}
-                old_ids = set(sheet_idx.keys())
+                if self.holds("bot") and time.monotonic() - stats_loaded >= self.ttl:
+                    # /stats is answered here but other workers write the store too
+                    await asyncio.to_thread(self.store.reload_stats)
+                    stats_loaded = time.monotonic()
+                for worker in self.rebalance():
+                    # whoever drops the dead heartbeat resends its alerts; the journal claims keep it once
+                    if self.store.drop_expired_lease(f"worker:{worker}"):
+                        log_info(f"[LEASE] worker {worker} expired, resending its pending alerts")
+                        await resume_notifications(self.store, worker)
             except Exception as e:
-                log_error("[GSHEET] Error reading sheet index", e)
-                sheet_idx = {}
-                old_ids = set()
+                log_error("[LEASE] Rebalance failed", e)
+            await asyncio.sleep(self.ttl / 3)
+
+    def release_all(self):
+        self.store.release_leases(self.worker)
+        self.held.clear()
+
+# =========================
+# Main monitoring
+# =========================
+def submit_alert(store: LotStore, chat_id: int, v: str, kind: str, text: str,
+                 send: Callable[[int], Awaitable], photo: Optional[str] = None) -> asyncio.Future:
+    """
+    dispatcher.submit() with a journal entry around it: an alert still queued when the
+    bot stops is resent by resume_notifications() on the next start.
+    """
+    entry = store.journal_add(chat_id, v, kind, text, photo, WORKER_ID)
+    done = dispatcher.submit(chat_id, send, f"[TG] {kind} {v}")
+    done.add_done_callback(lambda f: f.cancelled() or store.journal_done(entry, f.result()))
+    return done
+
+async def resume_notifications(store: LotStore, worker: str = ""):
+    """Requeues the alerts the previous run of `worker` (or a dead worker) detected but did not get to send."""
+    pending = store.journal_pending(worker)
+    cutoff = time.time() - NOTIFY_RESUME_MAX_AGE
+    resent = 0
+    for entry, chat_id, v, kind, text, photo, created in pending:
+        # the old entry is closed either way; a resent alert gets a new one
+        if not store.journal_claim(entry) or created < cutoff:
+            continue
+        if photo:
+            ref = PhotoRef(photo, store.photo_file_id(photo))
+            send = functools.partial(lambda c, ref, text: send_photo_ref(c, ref, text, store), ref=ref, text=text)
+        else:
+            send = functools.partial(lambda c, text: bot.send_message(c, text), text=text)
+        submit_alert(store, chat_id, v, kind, text, send, photo)
+        resent += 1
+    if pending:
+        log_info(f"[TG] Resuming undelivered alerts: {resent} resent, {len(pending) - resent} too old")
+    store.journal_prune(time.time() - 7 * 86400)
+
+async def notify_new_car(v: str, lot: Lot, store: LotStore, chat_ids: Iterable[int]):
+    img_url, msg = await format_car(lot)
+    if not img_url:
+        for chat_id in chat_ids:
+            submit_alert(store, chat_id, v, "NEW", msg, lambda c: bot.send_message(c, msg))
+        return
+
+    # The photo goes up once (to a private chat first, they have the higher rate limit);
+    # the other chats wait for it and reuse its file_id.
+    ref = PhotoRef(img_url, store.photo_file_id(img_url))
+
+    async def send_after_upload(c: int):
+        await ref.ready.wait()
+        return await send_photo_ref(c, ref, msg, store)
+
+    for i, chat_id in enumerate(sorted(chat_ids, key=lambda c: c < 0)):
+        if i == 0 and not ref.ready.is_set():
+            done = submit_alert(store, chat_id, v, "NEW", msg, lambda c: send_photo_ref(c, ref, msg, store), img_url)
+            done.add_done_callback(lambda _: ref.ready.set())
         else:
-            sheet_idx = {}
-            old_ids = set()
+            submit_alert(store, chat_id, v, "NEW", msg, send_after_upload, img_url)
 
-        # 2b) Repair incomplete rows
-        if sheet:
-            try:
-                repaired = repair_incomplete_rows(sheet, new_dict)
-                if repaired:
-                    log_info(f"[GSHEET] Repaired rows: {repaired}")
-            except Exception as e:
-                log_error("[GSHEET] Error repairing incomplete rows", e)
-
-        # 3) Deltas by vssId
-        added, removed = compare_ids(old_ids, new_ids)
-        log_info(f"[DIFF] added={len(added)} removed={len(removed)}")
-
-        # 4a) Remove disappeared ones (by descending indices), alerts after fact
-        if sheet and removed:
-            rows_to_delete: List[Tuple[int, str]] = []
-            for v in removed:
-                r = sheet_idx.get(v)
-                if r:
-                    rows_to_delete.append((r, v))
-            rows_to_delete.sort(key=lambda x: x[0], reverse=True)
-
-            actually_deleted: List[str] = []
-            for r, v in rows_to_delete:
-                try:
-                    sheet.delete_rows(r)
-                    log_info(f"[GSHEET] Deleted row vssId={v} (row={r})")
-                    actually_deleted.append(v)
-                except Exception as e:
-                    log_error(f"[GSHEET] Failed to delete vssId={v} (row={r})", e)
+async def notify_gone_car(v: str, store: LotStore, chat_ids: Iterable[int]):
+    txt = (
+        "❌ Lot disappeared from results\n"
+        f"<b>vssId:</b> <code>{v}</code>\n"
+        f'<a href="{car_url(v)}">Card</a>'
+    )
+    for chat_id in chat_ids:
+        submit_alert(store, chat_id, v, "GONE", txt, lambda c: bot.send_message(c, txt))
+
+async def notify_changed_car(v: str, row: list, deltas: Dict[str, Tuple], store: LotStore, chat_ids: Iterable[int]):
+    labels = {"price": "💶 Price", "mileage": "🛣️ Mileage", "model": "Model",
+              "gearbox": "⚙️ Transmission", "fuel": "⛽️ Fuel type"}
+    lines = []
+    for name, (old, new) in deltas.items():
+        if name == "price":
+            old, new = f"{format_price(old)} €", f"{format_price(new)} €"
+        elif name == "mileage":
+            old, new = f"{old} km", f"{new} km"
+        lines.append(f"<b>{labels[name]}:</b> {old} → {new}")
+    txt = (
+        "🔄 Lot changed\n"
+        f"<b>{row[1]}</b>\n"
+        f"<b>vssId:</b> <code>{v}</code>\n"
+        + "\n".join(lines) + "\n"
+        f'<a href="{car_url(v)}">Details</a>'
+    )
+    for chat_id in chat_ids:
+        submit_alert(store, chat_id, v, "CHANGED", txt, lambda c: bot.send_message(c, txt))
+
+def digest_line(lot: Lot) -> str:
+    return (f'<a href="{car_url(lot.vss_id)}">{lot.model}</a> · {format_price(lot.price)} € · '
+            f"{lot.mileage} km · {lot.gearbox} · {lot.fuel}")
+
+def paginate(header: str, lines: List[str], limit: int = TG_MESSAGE_LIMIT) -> List[str]:
+    """Splits lines into messages of at most `limit` characters, each starting with the header (and page x/n)."""
+    room = limit - len(header) - 16  # room for " (x/n)" and the newlines
+    pages: List[List[str]] = [[]]
+    size = 0
+    for line in lines:
+        if pages[-1] and size + len(line) + 1 > room:
+            pages.append([])
+            size = 0
+        pages[-1].append(line)
+        size += len(line) + 1
+    if len(pages) == 1:
+        return ["\n".join([header] + pages[0])]
+    return ["\n".join([f"{header} ({i}/{len(pages)})"] + page) for i, page in enumerate(pages, start=1)]
+
+async def send_album(chat_id: int, items: List[Tuple[str, str]], store: LotStore):
+    """One send_media_group of (image URL, caption) pairs; photos go by cached file_id where there is one."""
+    file_ids = [store.photo_file_id(url) for url, _ in items]
+    media = [InputMediaPhoto(media=fid or url, caption=cap) for (url, cap), fid in zip(items, file_ids)]
+    try:
+        msgs = await bot.send_media_group(chat_id, media)
+    except TelegramBadRequest:
+        if not any(file_ids):
+            raise
+        log_error(f"[TG] Album with cached file_ids rejected, resending by URL ({len(items)} photos)")
+        for url, _ in items:
+            store.set_photo_file_id(url, None)
+        msgs = await bot.send_media_group(chat_id, [InputMediaPhoto(media=url, caption=cap) for url, cap in items])
+    for (url, _), msg in zip(items, msgs or []):
+        if getattr(msg, "photo", None):
+            store.set_photo_file_id(url, msg.photo[-1].file_id)
+    return msgs
+
+async def notify_new_digest(items: List[Tuple[Lot, Optional[str]]], store: LotStore, chat_id: int):
+    """
+    New lots beyond the digest threshold, each with the image ingest_page resolved for it:
+    photo albums of up to TG_ALBUM_SIZE captioned lots, and the rest (no photo, or a lone
+    leftover) as compact lines in paginated text messages.
+    """
+    lots = [lot for lot, _ in items]
+    pictured = [(url, lot) for lot, url in items if url]
+    albums = [pictured[i:i + TG_ALBUM_SIZE] for i in range(0, len(pictured), TG_ALBUM_SIZE)]
+    if albums and len(albums[-1]) < 2:
+        albums.pop()
+    in_albums = {lot.vss_id for album in albums for _, lot in album}
+    lines = [digest_line(lot) for lot in lots if lot.vss_id not in in_albums]
+    header = f"🆕 <b>{len(lots)} more new lots</b>" + (f", {len(in_albums)} of them in the albums below" if albums else "")
+    for text in paginate(header, lines):
+        submit_alert(store, chat_id, "", "DIGEST", text, lambda c, text=text: bot.send_message(c, text))
+    for album in albums:
+        items = [(url, digest_line(lot)[:TG_CAPTION_LIMIT]) for url, lot in album]
+        # journaled as text: a resumed album comes back as a plain digest message
+        submit_alert(store, chat_id, "", "ALBUM", "\n".join(cap for _, cap in items),
+                     lambda c, items=items: send_album(c, items, store))
+
+async def notify_gone_digest(vss_ids: List[str], store: LotStore, chat_id: int):
+    lines = [f'<code>{v}</code> <a href="{car_url(v)}">Card</a>' for v in vss_ids]
+    for text in paginate(f"❌ <b>{len(vss_ids)} more lots disappeared from results</b>", lines):
+        submit_alert(store, chat_id, "", "DIGEST", text, lambda c, text=text: bot.send_message(c, text))
+
+async def send_digests(ctx: "SweepContext"):
+    """Sends what hold_for_digest() collected during the cycle, one digest per chat and kind."""
+    for (chat_id, kind), items in ctx.digests.items():
+        log_info(f"[TG] Digest for chat {chat_id}: {len(items)} {kind} lots")
+        metrics.inc("tg_digest_lots", len(items))
+        if kind == "NEW":
+            await notify_new_digest(items, ctx.store, chat_id)
+        else:
+            await notify_gone_digest(items, ctx.store, chat_id)
+    ctx.digests.clear()
 
-            for v in actually_deleted:
-                txt = (
-                    "❌ Lot disappeared from results\n"
-                    f"<b>vssId:</b> <code>{v}</code>\n"
-                    f'<a href="{car_url(v)}">Card</a>'
-                )
-                for chat_id in CHAT_IDS:
-                    ok = await tg_send_with_retry(lambda: bot.send_message(chat_id, txt))
-                    if ok:
-                        log_info(f"[TG] GONE {v} → chat {chat_id}")
-                    await asyncio.sleep(TELEGRAM_DELAY)
-
-        # 4b) Add new ones (update if already exists, otherwise append)
-        if sheet and added:
-            added_cnt = 0
-            sheet_idx = sheet_index_by_vssid(sheet)  # re-read index after deletions
-            for v in added:
-                car = new_dict.get(v)
-                if not car:
-                    continue
+class SweepContext:
+    """
+    State shared by the profiles of one cycle: a vehicle matched by several searches is
+    parsed, stored and checked for changes once, and each chat hears about it once.
+    """
+
+    def __init__(self, store: LotStore, profiles: List[SearchProfile], old_fps: Dict[str, Optional[str]],
+                 replay: Optional[Tuple[str, Dict[str, Dict[str, Lot]]]] = None, silent: Iterable[str] = (),
+                 known: Iterable[SearchProfile] = (), owns: Optional[Callable[[str], bool]] = None):
+        self.store = store
+        self.ts = replay[0] if replay else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.replay = replay[1] if replay else None  # archived {profile: lots} instead of the API
+        self.old_fps = old_fps
+        # chats of every configured profile, including those another worker sweeps
+        self.chats = {p.name: set(p.chat_ids) for p in (*known, *profiles)}
+        self.silent = set(silent)  # profiles taking a baseline: their lots are stored, not alerted
+        self.owns = owns or (lambda name: True)  # False once a worker's lease on the profile is gone
+        self.lot_cache: Dict[str, Lot] = {}
+        self.stored: Set[str] = set()    # added to the store this cycle
+        self.checked: Set[str] = set()   # fingerprint compared this cycle
+        self.alerted: Dict[str, Set[int]] = {}  # vssId -> chats told about it this cycle
+        self.alert_counts: Dict[Tuple[int, str], int] = {}  # (chat, "NEW"/"GONE") -> alerts this cycle
+        self.digests: Dict[Tuple[int, str], list] = {}  # (chat, kind) -> (lot, image) / vssIds held for send_digests
+        self.n_added = self.n_changed = 0
+
+    def chats_of(self, profiles: Iterable[str]) -> Set[int]:
+        out: Set[int] = set()
+        for name in profiles:
+            out |= self.chats.get(name, set())
+        return out
+
+    def hold_for_digest(self, chat_id: int, kind: str, item) -> bool:
+        """Counts one alert; past DIGEST_THRESHOLD this cycle it is queued for the digest (True) instead."""
+        key = (chat_id, kind)
+        n = self.alert_counts[key] = self.alert_counts.get(key, 0) + 1
+        if DIGEST_THRESHOLD <= 0 or n <= DIGEST_THRESHOLD:
+            return False
+        self.digests.setdefault(key, []).append(item)
+        return True
+
+async def apply_changes(ctx: SweepContext, changed: Dict[str, Lot]):
+    """Changed fingerprints: new rows for the store, sheet updates and alerts where visible fields differ."""
+    old_rows = ctx.store.rows(changed)
+    updates: Dict[str, Tuple[list, str]] = {}
+    to_sync: List[str] = []
+    to_alert: List[Tuple[str, list, Dict[str, Tuple]]] = []
+    for v, lot in changed.items():
+        old_row = old_rows.get(v) or []
+        row = build_full_row(lot)
+        row[7] = old_row[7] if len(old_row) > 7 and old_row[7] else row[7]  # keep date_added
+        updates[v] = (row, lot.fp)
+        deltas = field_deltas(old_row, row)
+        if deltas:
+            to_sync.append(v)
+            # lots seeded from the sheet have no fingerprint yet: adopt silently
+            alert = {k: d for k, d in deltas.items() if k in CHANGE_ALERT_FIELDS}
+            if alert and ctx.old_fps.get(v) is not None:
+                to_alert.append((v, row, alert))
+    # only the worker whose update lands alerts the change
+    done = ctx.store.update(updates, ctx.ts, to_sync, expected=ctx.old_fps)
+    to_alert = [a for a in to_alert if a[0] in done]
+    if to_sync:
+        log_info(f"[DIFF] lots with field changes: {len(to_sync)}")
+    owners = ctx.store.profiles_of(v for v, _, _ in to_alert)
+    for v, row, deltas in to_alert:
+        await notify_changed_car(v, row, deltas, ctx.store, ctx.chats_of(owners[v]))
+
+async def ingest_page(ctx: SweepContext, profile: SearchProfile, page: Dict[str, Lot], old_members: Set[str]):
+    """
+    One page of one profile's results. The store/sheet bookkeeping happens before the first
+    await, so pages of concurrently streamed profiles cannot interleave halfway through.
+    """
+    store = ctx.store
+    if all(v in old_members and ctx.old_fps.get(v) == lot.fp for v, lot in page.items()):
+        # steady state: nothing new, changed or joined on this page, only last_seen moves
+        metrics.inc("pages_unchanged")
+        store.touch(page, ctx.ts)
+        return
+    with metrics.timer("diff"):
+        added, changed = diff_page(ctx.old_fps, page)
+    changed = {v: lot for v, lot in changed.items() if v not in ctx.checked}
+    ctx.checked.update(changed)
+    fresh = {v: lot for v, lot in added.items() if v not in ctx.stored}
+    ctx.stored.update(fresh)
+    store.add(fresh, ctx.ts)
+    ctx.n_added += len(fresh)
+    ctx.n_changed += len(changed)
+
+    joined = [v for v in page if v not in old_members]
+    owners = store.join(profile.name, profile.sheet_tab, joined)  # who already had it
+    store.touch([v for v in page if v not in added and v not in changed], ctx.ts)
+
+    to_alert: List[Tuple[str, List[int]]] = []
+    for v in ([] if profile.name in ctx.silent else joined):
+        told = ctx.alerted.setdefault(v, set())
+        chats = [c for c in profile.chat_ids if c not in told and c not in ctx.chats_of(owners[v])]
+        if chats:
+            told.update(chats)
+            to_alert.append((v, chats))
+
+    if changed:
+        await apply_changes(ctx, changed)
+    if to_alert:
+        # resolved once here: the digests at the end of the cycle reuse these URLs
+        urls = await prefetch_images(page[v] for v, _ in to_alert)
+        for v, chats in to_alert:
+            chats = [c for c in chats if not ctx.hold_for_digest(c, "NEW", (page[v], urls.get(v)))]
+            if chats:
+                await notify_new_car(v, page[v], store, chats)
+
+async def sweep_profile(ctx: SweepContext, profile: SearchProfile) -> Tuple[Set[str], Set[str]]:
+    """Streams one profile's full result set through ingest_page. Returns (members before, seen)."""
+    old_members = ctx.store.members(profile.name)
+    seen: Set[str] = set()
+    if ctx.replay is not None:
+        pages = replay_pages(ctx.replay.get(profile.name, {}), ctx.lot_cache)
+    else:
+        pages = stream_lots(profile.data, ctx.lot_cache)
+    async for lots in pages:
+        if not ctx.owns(profile.name):
+            raise LeaseLostError(f"lease on {profile.name} lost mid-sweep")
+        page = {lot.vss_id: lot for lot in lots if lot.vss_id not in seen}
+        seen.update(page)
+        await ingest_page(ctx, profile, page, old_members)
+    return old_members, seen
+
+def archive_cycle(ts: str, results: Dict[str, Dict[str, Lot]]) -> int:
+    return sum(archive.record(ts, profile, lots) for profile, lots in results.items())
+
+async def replay_pages(lots: Dict[str, Lot], lot_cache: Dict[str, Lot], page_size: int = 100) -> AsyncIterator[List[Lot]]:
+    """An archived result set in API-sized pages, shaped like stream_lots."""
+    items = list(lots.values())
+    for i in range(0, len(items), page_size):
+        page = items[i:i + page_size]
+        for lot in page:
+            lot_cache.setdefault(lot.vss_id, lot)
+        yield page
+        await asyncio.sleep(0)
+
+async def full_sweep(profiles: List[SearchProfile], store: LotStore,
+                     replay: Optional[Tuple[str, Dict[str, Dict[str, Lot]]]] = None,
+                     silent: Iterable[str] = (), all_profiles: Iterable[SearchProfile] = (),
+                     owns: Optional[Callable[[str], bool]] = None) -> Optional[int]:
+    """
+    Full reconciliation cycle, streamed: the profiles' searches run concurrently and each page
+    is diffed against the local store, its new/changed lots stored and alerted while later
+    pages are still loading. Only removal detection waits for the end of all streams.
+    With `replay` = (cycle ts, {profile: lots}) from the archive, no API request is made.
+    Profiles named in `silent` only record what they find (no new-lot alerts).
+    `all_profiles` are every configured profile, when `profiles` is only this worker's share;
+    `owns(name)` tells whether the worker still holds the profile's lease (checked per page).
+    Returns the number of changes, or None if every profile failed.
+    """
+    t0 = time.perf_counter()
+    ctx = SweepContext(store, profiles, store.fingerprints(), replay, silent, all_profiles, owns)
+    log_info(f"[{ctx.ts}] New monitoring cycle")
+
+    results = await asyncio.gather(*(sweep_profile(ctx, p) for p in profiles), return_exceptions=True)
+    log_info(f"[+] Received cars (unique): {len(ctx.lot_cache)}")
+
+    # End of streams: per profile, lots it no longer returns leave it (and its tab);
+    # chats are told once, and only if no other profile of theirs still has the lot.
+    gone: Dict[str, Set[int]] = {}
+    results_by_profile: Dict[str, Dict[str, Lot]] = {}
+    n_removed = n_failed = 0
+    for profile, res in zip(profiles, results):
+        if isinstance(res, BaseException):
+            log_error(f"[DIFF] {profile.name}: sweep failed - skipping removals", res)
+            n_failed += 1
+            continue
+        old_members, seen = res
+        results_by_profile[profile.name] = {v: ctx.lot_cache[v] for v in seen}
+        if not seen and old_members:
+            log_error(f"[DIFF] {profile.name}: empty result set while lots are known - skipping removals")
+            continue
+        if not ctx.owns(profile.name):
+            log_error(f"[LEASE] {profile.name}: lease lost - skipping removals")
+            continue
+        _, removed = compare_ids(old_members, seen)
+        n_removed += len(removed)
+        owners = store.leave(profile.name, profile.sheet_tab, removed)
+        for v in removed:
+            chats = set(profile.chat_ids) - ctx.chats_of(owners[v])
+            gone.setdefault(v, set()).update(chats)
+
+    log_info(f"[DIFF] added={ctx.n_added} removed={n_removed} changed={ctx.n_changed}")
+    for v, chats in gone.items():
+        chats = [c for c in sorted(chats) if not ctx.hold_for_digest(c, "GONE", v)]
+        if chats:
+            await notify_gone_car(v, store, chats)
+    await send_digests(ctx)
+
+    if archive is not None and ctx.replay is None and results_by_profile:
+        try:
+            with metrics.timer("archive"):
+                stored = await run_blocking(_archive_pool, archive_cycle, ctx.ts, results_by_profile)
+            log_info(f"[ARCHIVE] Snapshot {ctx.ts}: {stored / 1024:.1f} KB")
+        except Exception as e:
+            log_error("[ARCHIVE] Could not store snapshot", e)
+
+    log_info("[*] Cycle completed.")
+    metrics.observe("cycle", time.perf_counter() - t0)
+    metrics.inc("lots_added", ctx.n_added)
+    metrics.inc("lots_changed", ctx.n_changed)
+    metrics.inc("lots_removed", n_removed)
+    if n_failed == len(profiles):
+        return None
+    return ctx.n_added + ctx.n_changed + n_removed
+
+async def head_poll(profiles: List[SearchProfile], store: LotStore,
+                    all_profiles: Iterable[SearchProfile] = (), owns: Optional[Callable[[str], bool]] = None) -> int:
+    """
+    Fast tier: alerts on lots from the profiles' top page(s) that they do not contain yet.
+    Returns their count; raises if any profile's poll failed (after alerting the others).
+    """
+    lot_cache: Dict[str, Lot] = {}
+    with metrics.timer("head_fetch"):
+        heads = await asyncio.gather(*(
+            run_blocking(_api_pool, get_head_bmw_lots, p.data, HEAD_PAGES, 100, lot_cache) for p in profiles
+        ), return_exceptions=True)
+    errors = [h for h in heads if isinstance(h, BaseException)]
+    # the profiles that did answer are still alerted; the poll as a whole counts as failed
+    pages = [{} if isinstance(lots, BaseException) else lots_by_id(lots) for lots in heads]
+    all_ids = set().union(*pages)
+    ctx = SweepContext(store, profiles, store.fingerprints(all_ids), known=all_profiles, owns=owns)
+    n_new = 0
+    for profile, page in zip(profiles, pages):
+        old_members = store.members(profile.name, page)
+        unseen = {v: lot for v, lot in page.items() if v not in old_members}
+        if not unseen or not ctx.owns(profile.name):
+            continue
+        log_info(f"[HEAD] {profile.name}: new lots on top page(s): {len(unseen)}")
+        n_new += len(unseen)
+        # already known lots are left to the full sweep
+        await ingest_page(ctx, profile, unseen, old_members)
+    await send_digests(ctx)
+    if errors:
+        raise errors[0]
+    return n_new
+
+async def seed_fresh_profiles(store: LotStore, profiles: List[SearchProfile]) -> Set[str]:
+    """
+    Seeds profiles the store knows no lots of from their sheet tabs.
+    Returns the ones whose first sweep must be a silent baseline.
+    """
+    fresh = [p for p in profiles if not store.members(p.name)]
+    if not fresh:
+        return set()
+    try:
+        book = await run_blocking(_sheets_pool, gs_open_book)
+        for p in fresh:
+            n = await run_blocking(_sheets_pool, bootstrap_store_from_sheet, store, book, p)
+            log_info(f"[STORE] {p.name}: seeded from Google Sheet: {n} lots")
+        return set()
+    except Exception as e:
+        # without the sheet we cannot tell what was already announced: take a silent baseline
+        # rather than alerting every lot the search returns
+        baseline = {p.name for p in fresh if not store.members(p.name)}
+        log_error(f"[STORE] Could not seed from Google Sheet, silent first sweep for: {', '.join(sorted(baseline))}", e)
+        return baseline
+
+async def monitor_loop(profiles: List[SearchProfile], store: LotStore,
+                       coordinator: Optional[LeaseCoordinator] = None):
+    """Sweeps `profiles`, or with a coordinator the ones this worker currently holds leases for."""
+    n = store.adopt_orphans(profiles[0].name, profiles[0].sheet_tab)
+    if n:
+        log_info(f"[STORE] Assigned {n} lots from before profiles to '{profiles[0].name}'")
+    baseline: Set[str] = set()  # profiles whose first sweep is recorded without alerts
+    active: List[SearchProfile] = []
+    owns = None if coordinator is None else (lambda name: coordinator.holds(f"profile:{name}"))
+
+    # Two tiers: full sweeps every POLL_INTERVAL..POLL_MAX_INTERVAL seconds and, in between,
+    # head polls of the top page(s) every HEAD_POLL_INTERVAL..HEAD_POLL_MAX_INTERVAL seconds.
+    rates = ChangeRateModel(store)
+    full_tier = AdaptiveSchedule("full", POLL_INTERVAL, POLL_MAX_INTERVAL, rates)
+    head_tier = AdaptiveSchedule("head", HEAD_POLL_INTERVAL, HEAD_POLL_MAX_INTERVAL, rates) \
+        if HEAD_POLL_INTERVAL > 0 else None
+    next_full = next_head = 0.0
+    while True:
+        owned = profiles if coordinator is None else coordinator.owned()
+        taken = [p for p in owned if p.name not in {a.name for a in active}]
+        if taken:
+            baseline |= await seed_fresh_profiles(store, taken)
+            if active:
+                log_info(f"[SCHED] took over {', '.join(p.name for p in taken)}: sweeping now")
+            next_full = 0.0
+        active = owned
+        if not active:
+            await asyncio.sleep(LEASE_TTL / 3)
+            continue
+
+        now = time.monotonic()
+        if now >= next_full:
+            changes = await full_sweep(active, store, silent=baseline, all_profiles=profiles, owns=owns)
+            if changes is not None and not baseline:  # a baseline's "changes" are the whole result set
+                rates.observe(changes)
+            baseline = {name for name in baseline if not store.members(name)}
+            delay = full_tier.next_delay(changes)
+            rate = rates.rate()
+            log_info(f"[SCHED] next full sweep in {delay:.0f}s "
+                     f"(quiet={full_tier.quiet}, errors={full_tier.errors}, "
+                     f"rate={'n/a' if rate is None else f'{rate:.1f}/h'})")
+            next_full = time.monotonic() + delay
+            if head_tier:
+                next_head = max(next_head, time.monotonic() + head_tier.fastest)
+        elif head_tier and now >= next_head:
+            # a profile still owing its silent baseline is left to the full sweep: its whole
+            # top page would look new
+            polled = [p for p in active if p.name not in baseline]
+            if not polled:
+                next_head = time.monotonic() + head_tier.fastest
+            else:
                 try:
-                    add_or_update_row_to_sheet(sheet, car, sheet_idx)
-                    added_cnt += 1
+                    changes = await head_poll(polled, store, all_profiles=profiles, owns=owns)
+                    rates.observe(changes)
                 except Exception as e:
-                    log_error(f"[GSHEET] Error adding/updating {v}", e)
-            if added_cnt:
-                log_info(f"[GSHEET] Added/updated rows: {added_cnt}")
-
-        # 5) Alerts about new lots
-        for v in added:
-            car = new_dict.get(v)
-            if not car:
-                continue
-            img_url, msg = format_car(car)
-            for chat_id in CHAT_IDS:
-                if img_url:
-                    ok = await tg_send_with_retry(lambda: bot.send_photo(chat_id, photo=img_url, caption=msg))
-                else:
-                    ok = await tg_send_with_retry(lambda: bot.send_message(chat_id, msg))
-                if ok:
-                    log_info(f"[TG] NEW {v} → chat {chat_id}")
-                await asyncio.sleep(TELEGRAM_DELAY)
-
-        log_info("[*] Cycle completed.")
-        await asyncio.sleep(POLL_INTERVAL)
-
-async def main():
-    data = build_beta_filters()
-    monitor_task = asyncio.create_task(monitor_loop(data))
-    await dp.start_polling(bot)
-    monitor_task.cancel()
+                    log_error("[HEAD] poll failed", e)
+                    changes = None
+                next_head = time.monotonic() + head_tier.next_delay(changes)
+
+        wake = next_full if head_tier is None else min(next_full, next_head)
+        # after a 429 nothing is sent before the API's Retry-After has passed,
+        # and nothing while the circuit breaker keeps the API closed
+        # (a worker wakes at least every LEASE_TTL/3 to pick up profiles it was given)
+        if coordinator is not None:
+            wake = min(wake, time.monotonic() + LEASE_TTL / 3)
+        await asyncio.sleep(max(wake - time.monotonic(), api_cooldown.remaining(), api_breaker.retry_in(), 0.0))
+
+class DryRunBot:
+    """Stands in for the Bot during a replay: sends are counted and logged, not delivered."""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def _record(self, chat_id: int, text: str):
+        self.sent += 1
+        log_info(f"[REPLAY] → chat {chat_id}: {text.splitlines()[0] if text else ''}")
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self._record(chat_id, text)
+
+    async def send_photo(self, chat_id: int, photo=None, caption: str = "", **kwargs):
+        await self._record(chat_id, caption)
+
+    async def send_media_group(self, chat_id: int, media, **kwargs):
+        await self._record(chat_id, f"album of {len(media)}: {media[0].caption if media else ''}")
+
+async def replay_archive(profiles: List[SearchProfile], speed: float, since: str = "", deliver: bool = False):
+    """
+    Feeds archived cycles through the diff/notify pipeline instead of the API, into a scratch
+    in-memory store. The first cycle is the baseline (stored silently, as if the bot had been
+    running); gaps between cycles are replayed `speed` times faster (0 = no waiting).
+    """
+    global bot, dispatcher, check_image_url, TG_CHAT_RATE, TG_GROUP_RATE_PER_MIN
+    if not deliver:
+        bot = DryRunBot()
+        check_image_url = lambda url: True  # noqa: E731 - no image probes in a dry run
+        TG_CHAT_RATE = TG_GROUP_RATE_PER_MIN = 1e6  # no Telegram limits to respect
+        dispatcher = TelegramDispatcher(1e6)
+    known = {p.name: p for p in profiles}
+    store = LotStore(":memory:")
+    prev_ts: Optional[datetime] = None
+    t0 = time.perf_counter()
+    n_cycles = 0
+    for ts, lots_by_profile in archive.cycles(since):
+        replay_profiles = [
+            known.get(name) or SearchProfile(name, {}, tuple(CHAT_IDS) or (0,), "") for name in lots_by_profile
+        ]
+        cur_ts = datetime.strptime(ts, "%Y-%m-%d %H:%M:%S")
+        if prev_ts is None:
+            known_ids: Set[str] = set()
+            for p in replay_profiles:
+                lots = lots_by_profile[p.name]
+                store.add({v: lot for v, lot in lots.items() if v not in known_ids}, ts)
+                known_ids.update(lots)
+                store.join(p.name, p.sheet_tab, lots)
+            log_info(f"[REPLAY] Baseline {ts}: {store.count()} lots")
+        else:
+            if speed > 0:
+                await asyncio.sleep((cur_ts - prev_ts).total_seconds() / speed)
+            await full_sweep(replay_profiles, store, replay=(ts, lots_by_profile))
+            n_cycles += 1
+        prev_ts = cur_ts
+    await dispatcher.join()
+    log_info(f"[REPLAY] {n_cycles} cycle(s) replayed in {time.perf_counter() - t0:.1f}s")
+    print(metrics.summary(), flush=True)
+
+async def main(profiles: List[SearchProfile]):
+    global state_store
+    store = state_store = LotStore(STATE_DB)
+    log_info(f"Profiles: {', '.join(p.name for p in profiles)}")
+    coordinator = LeaseCoordinator(store, WORKER_ID, profiles) if WORKER_ID else None
+    if coordinator is not None:
+        coordinator.rebalance()
+        log_info(f"[LEASE] worker {WORKER_ID}: {', '.join(p.name for p in coordinator.owned()) or 'no profiles yet'}")
+    metrics_server = start_metrics_server()
+    metrics.gauge("sheet_outbox", store.outbox_size)
+    await resume_notifications(store, WORKER_ID)
+    tasks = [
+        asyncio.create_task(monitor_loop(profiles, store, coordinator)),
+        asyncio.create_task(sheet_sync_loop(store, coordinator)),
+        asyncio.create_task(loop_lag.run()),
+    ]
+    if coordinator is not None:
+        tasks.append(asyncio.create_task(coordinator.run()))
     try:
-        await monitor_task
-    except asyncio.CancelledError:
-        pass
+        # Telegram allows one getUpdates consumer: among workers, the holder of `bot`
+        while coordinator is not None and not coordinator.holds("bot"):
+            await asyncio.sleep(coordinator.ttl / 3)
+        await dp.start_polling(bot)
+    finally:
+        if coordinator is not None:
+            coordinator.release_all()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    for t in tasks:
+        t.cancel()
+    for t in tasks:
+        try:
+            await t
+        except asyncio.CancelledError:
+            pass
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BMW used car monitor")
+    parser.add_argument("--replay", action="store_true", help="replay ARCHIVE_DB through the pipeline and exit")
+    parser.add_argument("--speed", type=float, default=60.0, help="replay speed-up (0 = as fast as possible)")
+    parser.add_argument("--since", default="", help="replay from this cycle timestamp (YYYY-MM-DD HH:MM:SS)")
+    parser.add_argument("--deliver", action="store_true", help="replay: really send to Telegram (default: dry run)")
+    parser.add_argument("--worker", default=WORKER_ID, help="worker id: share STATE_DB's profiles with other workers")
+    args = parser.parse_args()
+    WORKER_ID = args.worker.strip()
     try:
-        if not BOT_TOKEN or not CHAT_IDS:
-            print("Configuration error: check .env (BOT_TOKEN, CHAT_IDS)", flush=True)
+        profiles = load_profiles()
+        if not BOT_TOKEN or not all(p.chat_ids for p in profiles):
+            print("Configuration error: check .env (BOT_TOKEN, CHAT_IDS) and the profiles' chat_ids", flush=True)
             sys.exit(1)
-        asyncio.run(main())
+        archive = SnapshotArchive(ARCHIVE_DB) if ARCHIVE_DB else None
+        if args.replay:
+            if archive is None:
+                print("Configuration error: --replay needs ARCHIVE_DB", flush=True)
+                sys.exit(1)
+            asyncio.run(replay_archive(profiles, args.speed, args.since, args.deliver))
+        else:
+            asyncio.run(main(profiles))
     except KeyboardInterrupt:
         log_info("=== BMW Monitor stopped by KeyboardInterrupt ===")
     except Exception as e: